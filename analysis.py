@@ -1,55 +1,308 @@
 import mne
+import logging
+import scipy.fft
 from os.path import join
 import visuals as vis
 import io_helpers as i_o
+import artifact_registry as registry
 import numpy as np
 
 
-def calc_sensor_tfr(epochs, freqs, n_cycles, n_jobs, save_loc, sensor_tfr_name, paradigm):
+def calc_sensor_tfr(epochs, freqs, n_cycles, n_jobs, save_loc, sensor_tfr_name, paradigm, decim=1, crop=None):
     """
     :param epochs: epochs to calculate TFR objects from
     :param freqs: frequencies of interest
     :param n_jobs: job control to speed up computation
+    :param decim: integer decimation of the TFR output
+    :param crop: (tmin, tmax) tuple of the time window kept, None keeps the whole epoch
     :return: power and ITC TFR objects
     """
     if paradigm in ['fix', 'fixation', 'RestingState', 'EyesClosed', 'EyesOpen']:
         return
     power, itc = mne.time_frequency.tfr_morlet(epochs, freqs=freqs, n_cycles=n_cycles, use_fft=True, return_itc=True,
-                                               decim=1, n_jobs=n_jobs)
-    power.save(join(save_loc, sensor_tfr_name.replace('tfr_kind', 'power')), overwrite=True)
-    itc.save(join(save_loc, sensor_tfr_name.replace('tfr_kind', 'itc')), overwrite=True)
+                                               decim=decim, n_jobs=n_jobs)
+    if crop is not None:
+        power.crop(tmin=crop[0], tmax=crop[1])
+        itc.crop(tmin=crop[0], tmax=crop[1])
+    registry.register_artifact(join(save_loc, sensor_tfr_name.replace('tfr_kind', 'power')), power, i_o.save_tfr)
+    registry.register_artifact(join(save_loc, sensor_tfr_name.replace('tfr_kind', 'itc')), itc, i_o.save_tfr)
 
 
-def compute_psd(evoked, freqs, n_jobs, save_loc, sensor_psd_fname):
-    picks = ['eeg', 'meg'] if evoked.__contains__('eeg') else ['meg']
-    for p in picks:
-        psd, freqs = mne.time_frequency.psd_welch(evoked, fmin=freqs.min(), fmax=freqs.max(), picks=p, n_jobs=n_jobs)
-        np.save(join(save_loc, sensor_psd_fname.replace('CH_TYPE', p)), psd)
-        np.save(join(save_loc, sensor_psd_fname.replace('CH_TYPE', f'{p}_freqs')), freqs)
-    return
+def choose_tfr_decim(sfreq, freqs, oversampling=4.):
+    """
+    :param sfreq: sampling frequency of the epochs
+    :param freqs: analysis frequencies, the highest one bounds the decimation
+    :param oversampling: minimum ratio between the TFR output sampling frequency and the highest analysis frequency
+    :return: integer TFR output decimation (1 -> none)
+    """
+    return max(int(sfreq // (oversampling * np.max(freqs))), 1)
+
+
+def plan_tfr_time_indices(times, decim=1, crop=None):
+    """
+    :param times: array of epoch time points
+    :param decim: integer decimation of the TFR output, counted from the first sample as in MNE
+    :param crop: (tmin, tmax) tuple of the time window kept, None keeps the whole epoch
+    :return: array of the epoch sample indices the TFR is output at
+    """
+    time_indices = np.arange(len(times))[::decim]
+    if crop is not None:
+        time_indices = time_indices[(times[time_indices] >= crop[0]) & (times[time_indices] <= crop[1])]
+    return time_indices
+
+
+def morlet_coefs_float32(data, sfreq, freqs, n_cycles, time_indices=None, zero_mean=True):
+    """
+    single precision Morlet wavelet coefficients by FFT convolution, centered as tfr_array_morlet's ('same' mode)
+    :param data: array of trials, shape (n_epochs, n_channels, n_times)
+    :param time_indices: array of the sample indices to output (decimation/cropping), None outputs every sample
+    :return: complex64 coefficients, shape (n_epochs, n_channels, n_freqs, n_output_times)
+    """
+    n_times = data.shape[-1]
+    time_indices = np.arange(n_times) if time_indices is None else time_indices
+    wavelets = mne.time_frequency.morlet(sfreq, freqs, n_cycles=n_cycles, zero_mean=zero_mean)
+    n_fft = scipy.fft.next_fast_len(n_times + max(len(wavelet) for wavelet in wavelets) - 1)
+    data_fft = scipy.fft.fft(np.asarray(data, dtype=np.float32), n_fft, axis=-1) # complex64, computed once
+    coefs = np.empty(data.shape[:-1] + (len(freqs), len(time_indices)), dtype=np.complex64)
+    for freq_idx, wavelet in enumerate(wavelets):
+        convolved = scipy.fft.ifft(data_fft * scipy.fft.fft(wavelet.astype(np.complex64), n_fft), axis=-1)
+        coefs[..., freq_idx, :] = convolved[..., (len(wavelet) - 1) // 2 + time_indices]
+    return coefs
+
+
+def check_tfr_float32_tolerance(data, picks, sfreq, freqs, n_cycles, time_indices, tolerance, n_check=4):
+    """
+    compare the float32 coefficients of a few trials/channels with MNE's float64 tfr_array_morlet
+    :param data: array (or memory-mapped epoch store data) of trials, shape (n_epochs, n_channels, n_times)
+    :param picks: indices of the data channels
+    :param tolerance: maximum error, relative to the largest coefficient magnitude
+    :return: True if the float32 coefficients are within tolerance
+    """
+    data_check = np.asarray(data[:n_check][:, picks[:n_check]], dtype=np.float64)
+    reference = mne.time_frequency.tfr_array_morlet(data_check, sfreq, freqs, n_cycles=n_cycles, zero_mean=True,
+                                                    use_fft=True, decim=1, output='complex')[..., time_indices]
+    coefs = morlet_coefs_float32(data_check, sfreq, freqs, n_cycles, time_indices)
+    error = np.abs(coefs - reference).max() / np.abs(reference).max()
+    logging.info(f'float32 TFR relative error {error:.2e} (tolerance {tolerance:.0e})')
+    return error <= tolerance
+
+
+def calc_sensor_tfr_conditions(data, info, times, conditions_indices, freqs, n_cycles, n_jobs, save_loc,
+                               sensor_tfr_name, paradigm, max_block_gb=1., float32=False, decim=1, crop=None,
+                               tolerance=1e-3):
+    """
+    compute power and ITC of every condition from a single Morlet convolution of the union of their trials
+    :param data: array (or memory-mapped epoch store data) of all trials, shape (n_epochs, n_channels, n_times)
+    :param info: MNE Info object describing the channels of data
+    :param times: array of epoch time points
+    :param conditions_indices: dictionary whose keys are condition names, values are trial indices into data
+    :param freqs: frequencies of interest
+    :param n_jobs: job control to speed up computation
+    :param sensor_tfr_name: string of TFR filename pattern, containing the 'condition' and 'tfr_kind' placeholders
+    :param max_block_gb: memory budget for the complex wavelet coefficients of one block of channels
+    :param float32: boolean, True convolves in single precision (half the memory and disk), provided the result of a
+    few trials/channels is within tolerance of the float64 one
+    :param decim: integer decimation of the TFR output (see choose_tfr_decim)
+    :param crop: (tmin, tmax) tuple of the time window kept, None keeps the whole epoch
+    :return: dictionary whose keys are condition names, values are (power, ITC) TFR objects
+    """
+    if paradigm in ['fix', 'fixation', 'RestingState', 'EyesClosed', 'EyesOpen']:
+        return
+    picks = mne.pick_types(info, meg=True, eeg=True, ref_meg=False, exclude='bads') # data channels, as in tfr_morlet
+    n_epochs = data.shape[0]
+    time_indices = plan_tfr_time_indices(times, decim, crop)
+    if float32 and not check_tfr_float32_tolerance(data, picks, info['sfreq'], freqs, n_cycles, time_indices,
+                                                   tolerance):
+        logging.info('float32 TFR outside tolerance, computing in float64')
+        float32 = False
+    dtype = np.float32 if float32 else np.float64
+    # coefficients (complex) plus their magnitude and power (real) are held per channel block
+    bytes_per_channel = n_epochs * len(freqs) * len(time_indices) * 4 * np.dtype(dtype).itemsize
+    ch_block_size = max(int(max_block_gb * 1e9 // bytes_per_channel), 1)
+
+    powers = {condition: np.empty((len(picks), len(freqs), len(time_indices)), dtype) for condition in conditions_indices}
+    itcs = {condition: np.empty((len(picks), len(freqs), len(time_indices)), dtype) for condition in conditions_indices}
+    for block_start in range(0, len(picks), ch_block_size):
+        block_picks = picks[block_start:block_start + ch_block_size]
+        block_slice = slice(block_start, block_start + len(block_picks))
+        # per-trial coefficients for the block, shape (n_epochs, n_block_channels, n_freqs, n_output_times)
+        if float32:
+            coefs = morlet_coefs_float32(data[:, block_picks], info['sfreq'], freqs, n_cycles, time_indices)
+        else:
+            coefs = mne.time_frequency.tfr_array_morlet(np.asarray(data[:, block_picks], dtype=np.float64),
+                                                        info['sfreq'], freqs, n_cycles=n_cycles, zero_mean=True,
+                                                        use_fft=True, decim=decim, output='complex',
+                                                        n_jobs=n_jobs)[..., time_indices // decim]
+        coefs_abs = np.abs(coefs)
+        trial_power = coefs_abs ** 2
+        coefs_abs[coefs_abs == 0] = 1.
+        coefs /= coefs_abs # unit phase vectors, in place
+        del coefs_abs
+        for condition, trial_indices in conditions_indices.items(): # reduce each condition over its trials
+            powers[condition][block_slice] = trial_power[trial_indices].mean(axis=0)
+            itcs[condition][block_slice] = np.abs(coefs[trial_indices].mean(axis=0))
+        del coefs, trial_power
+
+    info_picked = mne.pick_info(info, picks)
+    tfrs = {}
+    for condition, trial_indices in conditions_indices.items():
+        power = mne.time_frequency.AverageTFR(info_picked, powers.pop(condition), times[time_indices], freqs,
+                                              len(trial_indices), method='morlet-power')
+        itc = mne.time_frequency.AverageTFR(info_picked, itcs.pop(condition), times[time_indices], freqs,
+                                            len(trial_indices), method='morlet-itc')
+        power_fname, itc_fname = [i_o.format_variable_names({'condition': condition, 'tfr_kind': tfr_kind}, sensor_tfr_name)
+                                  for tfr_kind in ['power', 'itc']]
+        registry.register_artifact(join(save_loc, power_fname), power, i_o.save_tfr) # written in the background
+        registry.register_artifact(join(save_loc, itc_fname), itc, i_o.save_tfr)
+        tfrs[condition] = (power, itc)
+    return tfrs
+
+
+def calc_sensor_psd_conditions(data, info, conditions_indices, freqs, n_jobs, method='welch', n_fft=256,
+                               block_size=64):
+    """
+    compute the spectra of every trial and channel, then average them per condition; trials shared by conditions are
+    transformed once and trials are read in float32 blocks, so only one block of data is in memory at a time
+    :param data: array (or memory-mapped epoch store data) of the trials, shape (n_epochs, n_channels, n_times)
+    :param info: MNE Info object describing the channels of data
+    :param conditions_indices: dictionary whose keys are condition names, values are trial indices into data
+    :param freqs: frequencies of interest, their range bounds the spectra
+    :param n_jobs: job control to speed up computation
+    :param method: string 'welch' or 'multitaper'; the window/tapers are planned once for all trials and conditions
+    :param n_fft: Welch segment length, limited to the epoch length
+    :param block_size: number of trials read and transformed at once
+    :return: dictionary whose keys are condition names, values are PSD arrays (n_channels, n_freqs)
+    :return: frequencies of the PSD arrays
+    """
+    picks = mne.pick_types(info, meg=True, eeg=True, ref_meg=False, exclude='bads')
+    trial_indices = np.unique(np.concatenate([np.asarray(indices, int) for indices in conditions_indices.values()]))
+    trials_psd = None
+    for block_start in range(0, len(trial_indices), block_size):
+        block_indices = trial_indices[block_start:block_start + block_size]
+        block_data = np.asarray(data[block_indices][:, picks], dtype=np.float32)
+        if method == 'multitaper':
+            block_psd, psd_freqs = mne.time_frequency.psd_array_multitaper(block_data, info['sfreq'], fmin=freqs.min(),
+                                                                           fmax=freqs.max(), n_jobs=n_jobs)
+        else:
+            block_psd, psd_freqs = mne.time_frequency.psd_array_welch(block_data, info['sfreq'], fmin=freqs.min(),
+                                                                      fmax=freqs.max(), n_jobs=n_jobs,
+                                                                      n_fft=min(n_fft, block_data.shape[-1]))
+        if trials_psd is None:
+            trials_psd = np.empty((len(trial_indices),) + block_psd.shape[1:])
+        trials_psd[block_start:block_start + len(block_indices)] = block_psd
+        del block_data
+    psds = {condition: trials_psd[np.searchsorted(trial_indices, indices)].mean(axis=0)
+            for condition, indices in conditions_indices.items()}
+    return psds, psd_freqs
+
+
+def save_sensor_psd(psds, psd_freqs, info, save_loc, sensor_psd_fname):
+    """
+    save the subject's PSD of every condition to a single file
+    :param psds: dictionary whose keys are condition names, values are PSD arrays (n_channels, n_freqs)
+    :param info: MNE Info object of the channels the PSDs were computed from, before picking
+    :param sensor_psd_fname: string of the subject's PSD filename (.npz)
+    """
+    info_picked = mne.pick_info(info, mne.pick_types(info, meg=True, eeg=True, ref_meg=False, exclude='bads'))
+    conditions = list(psds)
+    psd_arrays = {'psds': np.array([psds[condition] for condition in conditions]), 'freqs': psd_freqs,
+                  'conditions': np.array(conditions), 'ch_names': np.array(info_picked['ch_names']),
+                  'meg_picks': mne.pick_types(info_picked, meg=True, eeg=False, exclude=[]),
+                  'eeg_picks': mne.pick_types(info_picked, meg=False, eeg=True, exclude=[])}
+    registry.register_artifact(join(save_loc, sensor_psd_fname), psd_arrays, i_o.save_arrays)
+
+
+def read_sensor_psd(sensor_subdir, sensor_psd_name, condition):
+    """
+    :param sensor_psd_name: string of the subject's PSD filename (.npz)
+    :param condition: string condition name
+    :return: list of PSD arrays ordered as EEG (if present), MEG
+    :return: list of their frequencies
+    :return: list of channel types present ('eeg', 'meg')
+    """
+    psd_arrays = registry.get_artifact(join(sensor_subdir, sensor_psd_name), i_o.read_arrays)
+    psd = psd_arrays['psds'][list(psd_arrays['conditions']).index(condition)]
+    picks = ['eeg', 'meg'] if len(psd_arrays['eeg_picks']) else ['meg']
+    psds = [psd[psd_arrays[f'{pick}_picks']] for pick in picks] # copies, the registered arrays stay untouched
+    psds_freqs = [psd_arrays['freqs']] * len(picks)
+    return psds, psds_freqs, picks
+
+
+def summarize_tfr_windows(data, times, freqs, windows, reductions=('mean',)):
+    """
+    reduce a TFR over many time-frequency windows at once: the data are averaged over each window's band with a
+    cumulative sum along frequency, then over its time span with a cumulative sum along time
+    :param data: TFR array, shape (n_channels, n_freqs, n_times)
+    :param times: array of TFR time points
+    :param freqs: array of TFR frequencies
+    :param windows: list of dictionaries with 'name', 'tmin', 'tmax', 'fmin', 'fmax' keys
+    :param reductions: any of 'mean' (over the window), 'max' and 'peak_latency' (of the band averaged time course)
+    :return: dictionary whose keys are reductions, values are arrays (n_windows, n_channels), NaN for empty windows
+    """
+    f_start = np.searchsorted(freqs, [window['fmin'] for window in windows], side='left')
+    f_stop = np.searchsorted(freqs, [window['fmax'] for window in windows], side='right')
+    t_start = np.searchsorted(times, [window['tmin'] for window in windows], side='left')
+    t_stop = np.searchsorted(times, [window['tmax'] for window in windows], side='right')
+    empty = (f_stop <= f_start) | (t_stop <= t_start)
+
+    n_channels, n_freqs, n_times = data.shape
+    freq_cumsum = np.zeros((n_channels, n_freqs + 1, n_times))
+    np.cumsum(data, axis=1, out=freq_cumsum[:, 1:])
+    # band averaged time course of every window, shape (n_channels, n_windows, n_times)
+    band_courses = (freq_cumsum[:, f_stop] - freq_cumsum[:, f_start]) / np.maximum(f_stop - f_start, 1)[:, np.newaxis]
+
+    summaries = {}
+    if 'mean' in reductions:
+        time_cumsum = np.zeros(band_courses.shape[:2] + (n_times + 1,))
+        np.cumsum(band_courses, axis=2, out=time_cumsum[..., 1:])
+        window_idx = np.arange(len(windows))
+        summaries['mean'] = ((time_cumsum[:, window_idx, t_stop] - time_cumsum[:, window_idx, t_start]) /
+                             np.maximum(t_stop - t_start, 1)).T
+    if 'max' in reductions or 'peak_latency' in reductions:
+        in_window = (np.arange(n_times) >= t_start[:, np.newaxis]) & (np.arange(n_times) < t_stop[:, np.newaxis])
+        peaks = np.argmax(np.where(in_window, band_courses, -np.inf), axis=2)
+        if 'max' in reductions:
+            summaries['max'] = np.take_along_axis(band_courses, peaks[..., np.newaxis], axis=2)[..., 0].T
+        if 'peak_latency' in reductions:
+            summaries['peak_latency'] = times[peaks].T
+    for summary in summaries.values():
+        summary[empty] = np.nan
+    return summaries
+
+
+def save_tfr_summaries(tfrs, windows, reductions, condition, save_loc, summary_fname):
+    """
+    save the window summaries of TFRs as one tidy table (a row per TFR kind, window, reduction and channel)
+    :param tfrs: dictionary whose keys are TFR kinds ('power', 'itc'), values are TFR objects
+    :param summary_fname: string of the condition's summary filename (.csv)
+    """
+    header = ['condition', 'tfr_kind', 'window', 'tmin', 'tmax', 'fmin', 'fmax', 'reduction', 'ch_name', 'value']
+    rows = []
+    for tfr_kind, tfr in tfrs.items():
+        summaries = summarize_tfr_windows(tfr.data, tfr.times, tfr.freqs, windows, reductions)
+        for reduction, summary in summaries.items():
+            for window, window_summary in zip(windows, summary):
+                rows.extend([condition, tfr_kind, window['name'], window['tmin'], window['tmax'], window['fmin'],
+                             window['fmax'], reduction, ch_name, value]
+                            for ch_name, value in zip(tfr.ch_names, window_summary))
+    i_o.save_table(rows, header, save_loc, summary_fname)
 
 
 def analyze_sensor_space_and_make_figures(sensor_subdir, sensor_tfr_name, sensor_psd_name, freqs, tfr_temporal_dict,
-                                          sensor_tfr_plot_name, sensor_psd_plot_name):
-    # LOAD/IMPORT DATA
-    itc_match = i_o.find_file_matches(sensor_subdir, f"{sensor_tfr_name.replace('tfr_kind', 'itc')}")
-    power_match = i_o.find_file_matches(sensor_subdir, f"{sensor_tfr_name.replace('tfr_kind', 'power')}")
-    psd_matches = sorted(i_o.find_file_matches(sensor_subdir, f"{sensor_psd_name.replace('CH_TYPE', '???')}"))
-    psd_freq_matches = sorted(i_o.find_file_matches(sensor_subdir, f"{sensor_psd_name.replace('CH_TYPE', '???_freqs')}"))
-    try:
-        itc = mne.time_frequency.read_tfrs(join(sensor_subdir, itc_match[0]))[0]
-        power = mne.time_frequency.read_tfrs(join(sensor_subdir, power_match[0]))[0]
-    except IndexError: # no ITC/power TFR data available, because paradigm is fixation
+                                          sensor_tfr_plot_name, sensor_psd_plot_name, condition, tfr_windows=(),
+                                          tfr_reductions=('mean',), sensor_tfr_summary_name=None):
+    # LOAD/IMPORT DATA, from memory if computed in this process
+    itc_path = join(sensor_subdir, sensor_tfr_name.replace('tfr_kind', 'itc'))
+    power_path = join(sensor_subdir, sensor_tfr_name.replace('tfr_kind', 'power'))
+    if registry.has_artifact(itc_path) and registry.has_artifact(power_path):
+        itc = registry.get_artifact(itc_path, i_o.read_tfr)
+        power = registry.get_artifact(power_path, i_o.read_tfr)
+    else: # no ITC/power TFR data available, because paradigm is fixation
         itc = None
         power = None
 
-    psds = [np.load(join(sensor_subdir, psd_match)) for psd_match in psd_matches]
-    psds_freqs = [np.load(join(sensor_subdir, psd_freq_match)) for psd_freq_match in psd_freq_matches]
-    psd_eeg = psds[0] if len(psds) == 2 else None
-    psd_meg = psds[-1]
-
-    # DETERMINE EEG AVAILABILITY
-    picks = ['eeg', 'meg'] if isinstance(psd_eeg, np.ndarray) else ['meg']
+    # condition's PSDs and EEG availability
+    psds, psds_freqs, picks = read_sensor_psd(sensor_subdir, sensor_psd_name, condition)
 
     t_start = tfr_temporal_dict['t_start']
     t_end = tfr_temporal_dict['t_end']
@@ -57,6 +310,9 @@ def analyze_sensor_space_and_make_figures(sensor_subdir, sensor_tfr_name, sensor
     # check if ITC/power are available (not None), then begin analyzing
     if not isinstance(itc, type(None)):
         # ITC and power available...
+        if tfr_windows and sensor_tfr_summary_name: # every window summarized from the TFRs loaded above
+            save_tfr_summaries({'power': power, 'itc': itc}, tfr_windows, tfr_reductions, condition, sensor_subdir,
+                               sensor_tfr_summary_name)
         vis.plot_sensor_space_tfr(itc, power, picks, sensor_subdir, sensor_tfr_plot_name.replace('filler', 'TFR'))
 
         itc_cropped = itc.copy().crop(tmin=t_start, tmax=t_end)
@@ -0,0 +1,81 @@
+"""
+Artifact registry - hands freshly computed objects (TFRs, PSDs...) straight to the stages consuming them
+Registered objects are kept in memory and written to disk by a single background thread, so the computing stage does
+not wait for the write and the consuming stage does not read the file back; the file is read only on a cache miss
+(ex: a later run that skipped the computation)
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists
+
+artifacts = {} # path -> object registered or loaded in this process
+pending_writes = {} # path -> future of its background write
+writer = None # single thread, so writes to the same storage do not compete
+
+
+def register_artifact(path, artifact, save_func):
+    """
+    keep an artifact in memory and write it to disk in the background
+    :param path: string denoting the artifact's file
+    :param artifact: object to register, must not be modified afterwards (it may still be being written)
+    :param save_func: function called as save_func(path, artifact)
+    :return: the artifact
+    """
+    global writer
+    if writer is None:
+        writer = ThreadPoolExecutor(max_workers=1)
+    if path in pending_writes: # an earlier version of the file must be written first
+        pending_writes.pop(path).result()
+    artifacts[path] = artifact
+    pending_writes[path] = writer.submit(save_func, path, artifact)
+    return artifact
+
+
+def has_artifact(path):
+    """ :return: True if the artifact is registered in memory or saved on disk"""
+    return path in artifacts or exists(path)
+
+
+def get_artifact(path, load_func):
+    """
+    :param path: string denoting the artifact's file
+    :param load_func: function called as load_func(path) when the artifact is not in memory
+    :return: the registered artifact, or the one loaded from disk
+    """
+    if path not in artifacts:
+        logging.info(f'{path} not in memory, reading it from disk')
+        artifacts[path] = load_func(path)
+    return artifacts[path]
+
+
+def flush_artifacts():
+    """ wait for every background write to finish, raising the first write error"""
+    errors = []
+    for path, future in list(pending_writes.items()):
+        try:
+            future.result()
+        except Exception as error:
+            logging.error(f'Writing {path} failed: {error!r}')
+            errors.append(error)
+        pending_writes.pop(path, None)
+    if errors:
+        raise errors[0]
+
+
+def clear_artifacts():
+    """ finish the background writes, then release the artifacts held in memory"""
+    try:
+        flush_artifacts()
+    finally:
+        artifacts.clear()
+
+
+def discard_artifacts():
+    """ after a failure: wait for the background writes, logging write errors instead of raising them, then release
+    the artifacts held in memory"""
+    try:
+        flush_artifacts()
+    except Exception: # already logged per artifact by flush_artifacts
+        pass
+    finally:
+        artifacts.clear()
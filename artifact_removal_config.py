@@ -2,9 +2,6 @@
 Artifact removal configuration file
 Holds parameters used in SSP and ICA methods to remove eye blinks and heart beats
 """
-from os.path import join
-import paradigm_config as para_cfg
-
 # SSP parameters
 n_grad_ssp = 2
 n_mag_ssp = 2
@@ -23,9 +20,3 @@ n_comps_ica = 0.999
 fit_method_ica = 'fastica'
 random_state_ica = 42
 ica_params_dict = {'n_components': n_comps_ica, 'fit_method': fit_method_ica, 'random_state': random_state_ica}
-
-artifact_removal_vars_output_filename = f'{para_cfg.paradigm}_sss_config_variables_output_{para_cfg.current_datetime}.txt'
-with open(join(para_cfg.paradigm_dir, artifact_removal_vars_output_filename), 'w+') as var_output:
-    for var_name, value in dict(vars()).items():
-        var_output.write(f'{var_name}: {value}\n')
-var_output.close()
\ No newline at end of file
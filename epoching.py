@@ -2,9 +2,12 @@ import paradigm_config as para_cfg
 import logging
 import io_helpers as i_o
 import preprocessing as preproc
+import visuals as vis
 import artifact_removal_config as rm_arti_cfg
+import stage_cache as cache
 from os.path import join, exists
 import os
+import sys
 import fnmatch
 from mne.io import read_raw_fif as rrf
 from mne import find_events
@@ -12,6 +15,7 @@ from mne import find_events
 
 def main(subject, subject_fnames, log):
     logging.basicConfig(filename=log, level=logging.DEBUG)
+    vis.start_render_pool(para_cfg.n_render_workers) # SSP topographies are rendered in the background
 
     subject_paradigm_dir = join(para_cfg.paradigm_dir, subject)
 
@@ -20,22 +24,55 @@ def main(subject, subject_fnames, log):
     
     if not exists(join(subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm'])):
         return
-    if exists(join(subject_fnames['preproc_subdir'], subject_fnames['filt_paradigm'])):
+    # re-run filtering, SSP and epoching only if the SSS'd data, their parameters or code changed
+    epoching_params = {'l_freq': para_cfg.l_freq, 'h_freq': para_cfg.h_freq, 'paradigm': para_cfg.paradigm,
+                       'fused_filter': para_cfg.fused_filter, 'fused_filter_tolerance': para_cfg.fused_filter_tolerance,
+                       'notch_ch_types': para_cfg.notch_ch_types,
+                       'process_eeg': para_cfg.process_eeg, 'decimate': para_cfg.decimate, 'freqs': para_cfg.freqs,
+                       'epoch_dur': para_cfg.epoch_dur, 'conditions_dicts': para_cfg.conditions_dicts,
+                       'epochs_parameters_dict': {key: value for key, value in para_cfg.epochs_parameters_dict.items()
+                                                  if key != 'event_id'}, # event_id is filled per condition
+                       'preproc_ssp': para_cfg.preproc_ssp, 'ssp_dict': rm_arti_cfg.ssp_dict,
+                       'epoch_store': para_cfg.epoch_store, 'epoch_reject_learned': para_cfg.epoch_reject_learned}
+    epoching_fingerprint = cache.fingerprint_stage([join(subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm'])],
+                                                   epoching_params, [sys.modules[__name__], preproc, i_o])
+    if cache.is_stage_current(subject_fnames['preproc_subdir'], subject_fnames['filt_paradigm'], epoching_fingerprint):
         return
     
-    sssd_data = i_o.preload_raws(subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm'])[0]
-    
-    events, events_differential_corrected = i_o.find_events(sssd_data, 'STI101', para_cfg.paradigm, para_cfg.epoch_dur)
-    
-    filt = preproc.filter_signal(sssd_data, para_cfg.l_freq, para_cfg.h_freq, para_cfg.n_jobs, subject_paradigm_dir,
-                                 subject_fnames['eeg_bads'], subject_fnames['preproc_subdir'], subject_fnames['filt_paradigm'],
-                                 para_cfg.epochs_parameters_dict)
-    
-    if para_cfg.preproc_ssp:
-        raw_sss_filt_ssp = preproc.ssp_exg(filt, rm_arti_cfg.ssp_dict, para_cfg.n_jobs, subject_fnames['proj'],
-                                       subject_fnames['preproc_subdir'], subject_fnames['ssp_topo'], subject_fnames['preproc_plots_subdir'])
-    
+    memmap_dir = subject_fnames['raw_memmap_subdir'] if para_cfg.raw_memmap else None
+    try:
+        sssd_data = i_o.preload_raws(subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm'],
+                                     memmap_dir=memmap_dir)[0]
 
-    preproc.generate_epochs(raw_sss_filt_ssp, events, para_cfg.conditions_dicts,
-                            para_cfg.epochs_parameters_dict, subject_fnames['epochs_subdir'], subject_fnames['epoch'])
-    
+        events, events_differential_corrected = i_o.find_events(sssd_data, 'STI101', para_cfg.paradigm, para_cfg.epoch_dur)
+
+        filt = preproc.filter_signal(sssd_data, para_cfg.l_freq, para_cfg.h_freq, para_cfg.n_jobs, subject_paradigm_dir,
+                                     subject_fnames['eeg_bads'], subject_fnames['preproc_subdir'], subject_fnames['filt_paradigm'],
+                                     para_cfg.epochs_parameters_dict, save=False, fused=para_cfg.fused_filter,
+                                     notch_ch_types=para_cfg.notch_ch_types, events=events,
+                                     process_eeg=para_cfg.process_eeg, fused_tolerance=para_cfg.fused_filter_tolerance)
+
+        if para_cfg.decimate: # every downstream stage handles fewer samples
+            decim = preproc.plan_decimation(filt.info['sfreq'], para_cfg.h_freq, para_cfg.freqs,
+                                            para_cfg.epoch_tmin, para_cfg.epoch_tmax)
+            filt, events = preproc.decimate_signal(filt, events, decim, para_cfg.n_jobs, subject_fnames['preproc_subdir'],
+                                                   subject_fnames['decim'])
+        # saved once decimated, so the filtered signal matches the events, SSP and epochs derived from it
+        filt.save(join(subject_fnames['preproc_subdir'], subject_fnames['filt_paradigm']), overwrite=True)
+
+        if para_cfg.preproc_ssp:
+            raw_sss_filt_ssp = preproc.ssp_exg(filt, rm_arti_cfg.ssp_dict, para_cfg.n_jobs, subject_fnames['proj'],
+                                           subject_fnames['preproc_subdir'], subject_fnames['ssp_topo'], subject_fnames['preproc_plots_subdir'])
+
+        epoch_store_name = subject_fnames['epoch_store'] if para_cfg.epoch_store else None
+        drop_log_fname = subject_fnames['drop_log'] if para_cfg.epoch_reject_learned else None
+        preproc.generate_epochs(raw_sss_filt_ssp, events, para_cfg.conditions_dicts,
+                                para_cfg.epochs_parameters_dict, subject_fnames['epochs_subdir'], subject_fnames['epoch'],
+                                epoch_store_name, drop_log_fname)
+        vis.flush_renders()
+    except Exception: # the failure itself is raised, not an error of the figures pending
+        vis.discard_renders()
+        raise
+    finally: # memmaps are removed even when the visit fails
+        i_o.remove_memmaps(memmap_dir)
+    cache.record_stage(subject_fnames['preproc_subdir'], subject_fnames['filt_paradigm'], epoching_fingerprint)
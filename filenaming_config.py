@@ -1,5 +1,4 @@
 import paradigm_config as para_cfg
-import io_helpers as i_o
 from os.path import join
 
 ### TOP LEVEL: HARD-CODED LOCATIONS
@@ -9,8 +8,6 @@ meg_dir = para_cfg.meg_dir # MEG directory
 paradigm = para_cfg.paradigm # paradigm definition
 paradigm_dir = para_cfg.paradigm_dir
 
-filenaming_vars_output_filename = f'{paradigm}_filenaming_config_variables_output_{para_cfg.current_datetime}.txt'
-
 ### LOW LEVEL: filenaming and breadcrumbs
 sss_ext = 'raw_sss.fif'
 
@@ -20,13 +17,16 @@ ssp_topo_ext = proj_ext.replace('.fif', '_topomap.png')
 filt_ext = '_'.join((f'{para_cfg.l_freq}hp_{para_cfg.h_freq}lp', sss_ext))
 epoch_ext = filt_ext.replace('raw_sss', f'raw_sss_condition_{int(para_cfg.epoch_dur)}ms-epo')
 evoked_ext = epoch_ext.replace('epo', 'ave')
+drop_log_ext = epoch_ext.replace('condition_', '').replace('-epo.fif', '-epo_drop_log.json')
+epoch_store_ext = epoch_ext.replace('condition_', '').replace('-epo.fif', '-epo-store') # directory, all conditions
 
 sensor_evoked_ext = epoch_ext.replace('epo.fif', 'evoked_filler.png')
 sensor_tfr_ext = epoch_ext.replace('epo.fif', 'tfr_kind-tfr.h5')
-sensor_psd_ext = epoch_ext.replace('epo.fif', 'CH_TYPE_psd.npy')
+sensor_psd_ext = epoch_ext.replace('condition_', '').replace('-epo.fif', '-psd.npz') # all conditions
 
+sensor_tfr_summary_ext = sensor_tfr_ext.replace('tfr_kind-tfr.h5', 'tfr_summary.csv')
 sensor_tfr_plot_ext = sensor_tfr_ext.replace('tfr_kind-tfr.h5', '_filler.png')
-sensor_psd_plot_ext = sensor_psd_ext.replace('CH_TYPE_psd.npy', 'PSD.png')
+sensor_psd_plot_ext = epoch_ext.replace('epo.fif', 'PSD.png')
 
 inv_ext = epoch_ext.replace('epo', 'inv')
 
@@ -35,6 +35,8 @@ maxwell_script_log_name = f'{paradigm}_maxwell_script_{para_cfg.current_datetime
 epoched_script_log_name = f'{paradigm}_epoch_script_{para_cfg.current_datetime}.log'
 sensor_space_script_log_name = f'{paradigm}_sensor_space_script_{para_cfg.current_datetime}.log'
 inverse_script_log_name = f'{paradigm}_inverse_sol_script_{para_cfg.current_datetime}.log'
+subject_job_log_name = f'{paradigm}_subject_job_{para_cfg.current_datetime}.log' # per visit, in its preprocessing directory
+run_summary_log_name = f'{paradigm}_run_summary_{para_cfg.current_datetime}.log' # per run, in the reports directory
 
 def create_paradigm_subject_mapping(subject, visit_folder):
     """ create a dictionary whose keys are relevant/required subdirectories/filenames,
@@ -53,6 +55,7 @@ def create_paradigm_subject_mapping(subject, visit_folder):
 
     subject_filenames_dict['epochs_subdir'] = join(subject_paradigm_dir, visit_folder, 'epoched')
     subject_filenames_dict['preproc_subdir'] = join(subject_paradigm_dir, visit_folder, 'preprocessing')
+    subject_filenames_dict['raw_memmap_subdir'] = join(subject_paradigm_dir, visit_folder, 'raw_memmap')
 
     subject_filenames_dict['epochs_sensor_subdir'] = join(subject_filenames_dict['epochs_subdir'], 'sensor_space')
     subject_filenames_dict['preproc_plots_subdir'] = join(subject_filenames_dict['preproc_subdir'], 'plots')
@@ -73,12 +76,16 @@ def create_paradigm_subject_mapping(subject, visit_folder):
     subject_filenames_dict['ssp_topo'] = '_'.join((subject_paradigm_date_tag, ssp_topo_ext))
 
     subject_filenames_dict['filt_paradigm'] = '_'.join((subject_paradigm_date_tag, filt_ext))
+    subject_filenames_dict['decim'] = '_'.join((subject_paradigm_date_tag, 'decimation_factor.txt'))
 
     subject_filenames_dict['epoch'] = '_'.join((subject_paradigm_date_tag, epoch_ext))
     subject_filenames_dict['evoked'] = '_'.join((subject_paradigm_date_tag, evoked_ext))
+    subject_filenames_dict['drop_log'] = '_'.join((subject_paradigm_date_tag, drop_log_ext))
+    subject_filenames_dict['epoch_store'] = '_'.join((subject_paradigm_date_tag, epoch_store_ext))
     subject_filenames_dict['sensor_tfr'] = '_'.join((subject_paradigm_date_tag, sensor_tfr_ext))
     subject_filenames_dict['sensor_psd'] = '_'.join((subject_paradigm_date_tag, sensor_psd_ext))
 
+    subject_filenames_dict['sensor_tfr_summary'] = '_'.join((subject_paradigm_date_tag, sensor_tfr_summary_ext))
     subject_filenames_dict['sensor_tfr_plot'] = '_'.join((subject_paradigm_date_tag, sensor_tfr_plot_ext))
     subject_filenames_dict['sensor_psd_plot'] = '_'.join((subject_paradigm_date_tag, sensor_psd_plot_ext))
     subject_filenames_dict['evoked_plot'] = '_'.join((subject_paradigm_date_tag, sensor_evoked_ext))
@@ -89,9 +96,3 @@ def create_paradigm_subject_mapping(subject, visit_folder):
     subject_filenames_dict['coreg_plot'] = '_'.join((subject_paradigm_date_tag, 'alignment_plot.png'))
 
     return subject_filenames_dict
-
-
-with open(join(paradigm_dir, filenaming_vars_output_filename), 'w+') as var_output:
-    for var_name, value in dict(vars()).items():
-        var_output.write(f'{var_name}: {value}\n')
-var_output.close()
\ No newline at end of file
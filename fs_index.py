@@ -0,0 +1,127 @@
+"""
+Filesystem index - directory listings served from memory, refreshed only when a directory changes
+Every listing records its entries' types along with the directory's own mtime; a directory is listed again if its mtime
+changed (an entry was added, removed or renamed) or its listing is not confirmed yet: filesystem timestamps are coarse,
+so a change within the same tick as the listing would go unnoticed, and a listing is only trusted once a later listing
+found the same entries under the same mtime (no clock is compared, NFS server and client clocks may drift)
+Stage outputs found are stat'ed directly, as a file rewritten in place does not change its directory's mtime
+"""
+import json
+import fnmatch
+import logging
+from os import scandir, stat, replace, makedirs
+from os.path import join, exists, dirname
+
+listing_cache = {} # directory path -> (directory mtime_ns, {entry name: is directory}, confirmed)
+
+
+def list_dir(path):
+    """
+    :param path: string denoting a directory
+    :return: dictionary whose keys are entry names, values are True for directories
+    """
+    dir_mtime_ns = stat(path).st_mtime_ns # raises FileNotFoundError like listdir
+    cached = listing_cache.get(path)
+    if cached and cached[0] == dir_mtime_ns and cached[2]:
+        return cached[1]
+    entries = {}
+    with scandir(path) as dir_entries:
+        for dir_entry in dir_entries:
+            try:
+                entries[dir_entry.name] = dir_entry.is_dir()
+            except FileNotFoundError: # removed while listing
+                continue
+    confirmed = bool(cached) and cached[0] == dir_mtime_ns and cached[1] == entries
+    listing_cache[path] = (dir_mtime_ns, entries, confirmed)
+    return entries
+
+
+def match_entries(path, pattern):
+    """
+    :param path: string denoting a directory
+    :param pattern: string to identify entries specified by it
+    :return: sorted list of the directory's entry names matching the pattern
+    """
+    return sorted(fnmatch.filter(list_dir(path), pattern))
+
+
+def scan_subject_visits(paradigm_dir):
+    """
+    list the paradigm's subject/visit folders (paradigm_dir/subject/visit_YYYYMMDD), two directory levels only
+    :return: list of (subject, visit folder) tuples
+    """
+    subject_visits = []
+    for subject, subject_is_dir in sorted(list_dir(paradigm_dir).items()):
+        if not subject_is_dir:
+            continue
+        for visit_folder, visit_is_dir in sorted(list_dir(join(paradigm_dir, subject)).items()):
+            visit_parts = visit_folder.split('_')
+            if visit_is_dir and 'visit' in visit_folder and len(visit_parts) > 1 and len(visit_parts[1]) == 8:
+                subject_visits.append((subject, visit_folder))
+    logging.info(f'{len(subject_visits)} subject visits found in {paradigm_dir}')
+    return subject_visits
+
+
+def get_output_mtime_ns(output_dir, output_pattern):
+    """
+    :return: mtime_ns of the newest entry of output_dir matching output_pattern, None if there is none
+    """
+    mtimes_ns = []
+    for name in match_entries(output_dir, output_pattern):
+        try:
+            mtimes_ns.append(stat(join(output_dir, name)).st_mtime_ns)
+        except FileNotFoundError: # removed since the directory was listed
+            continue
+    return max(mtimes_ns) if mtimes_ns else None
+
+
+def find_missing_outputs(subject_visits, get_expected_outputs):
+    """
+    :param subject_visits: list of (subject, visit folder) tuples
+    :param get_expected_outputs: function called as get_expected_outputs(subject, visit_folder), returning a dictionary
+    whose keys are output names, values are (directory, filename pattern) tuples, in stage order
+    :return: dictionary whose keys are (subject, visit folder) tuples, values are lists of their missing output names,
+    and of the outputs older than the previous stage's output, marked as stale
+    """
+    missing_outputs = {}
+    for subject, visit_folder in subject_visits:
+        missing = []
+        previous_mtime_ns = None
+        for output_name, (output_dir, output_pattern) in get_expected_outputs(subject, visit_folder).items():
+            try:
+                output_mtime_ns = get_output_mtime_ns(output_dir, output_pattern)
+            except (FileNotFoundError, NotADirectoryError): # the stage never created its directory
+                output_mtime_ns = None
+            if output_mtime_ns is None:
+                missing.append(output_name)
+            elif previous_mtime_ns is not None and output_mtime_ns < previous_mtime_ns:
+                missing.append(f'{output_name} (stale)')
+            previous_mtime_ns = output_mtime_ns if output_mtime_ns is not None else previous_mtime_ns
+        if missing:
+            missing_outputs[(subject, visit_folder)] = missing
+    return missing_outputs
+
+
+def save_index(index_path):
+    """ persist the listings, so the next run only lists directories that changed since"""
+    makedirs(dirname(index_path), exist_ok=True)
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'w') as index_file:
+        json.dump(listing_cache, index_file)
+    replace(tmp_path, index_path)
+
+
+def load_index(index_path):
+    """ load listings persisted by save_index, a missing, corrupt or outdated index is rebuilt as directories are listed"""
+    if not exists(index_path):
+        return
+    try:
+        with open(index_path) as index_file:
+            saved = json.load(index_file)
+        listings = {path: (dir_mtime_ns, {name: bool(is_dir) for name, is_dir in entries.items()}, bool(confirmed))
+                    for path, (dir_mtime_ns, entries, confirmed) in saved.items()}
+    except (ValueError, TypeError, AttributeError):
+        logging.info(f'{index_path} is corrupt or outdated, directories will be listed again')
+        return
+    for path, listing in listings.items():
+        listing_cache.setdefault(path, listing)
@@ -1,9 +1,13 @@
 import mne
+import csv
+import json
 import fnmatch
+import inspect
 import logging
 import numpy as np
-from os.path import join, isdir, isfile, exists
-from os import mkdir, listdir
+import fs_index
+from os.path import join, isdir, isfile
+from os import mkdir, makedirs, listdir, remove, rmdir, getpid
 
 
 def find_file_matches(loc, pattern):
@@ -12,27 +16,80 @@ def find_file_matches(loc, pattern):
     :param pattern: string to identify file(s) specified by it
     :return: list of file(s) found matching a given pattern, in a given location
     """
-    files_matching_pattern = fnmatch.filter(listdir(loc), pattern)
-    file_matches = [] if len(files_matching_pattern) == 0 else files_matching_pattern
-    logging.info(f'The following {len(file_matches)} were found matching the pattern {pattern} in {loc}:\n{listdir(loc)}')
+    dir_entries = fs_index.list_dir(loc) # listed once, then served from memory until the directory changes
+    file_matches = sorted(fnmatch.filter(dir_entries, pattern))
+    logging.info(f'The following {len(file_matches)} were found matching the pattern {pattern} in {loc}:\n{sorted(dir_entries)}')
     return file_matches
 
 
-def preload_raws(loc, pattern):
+def preload_raws(loc, pattern, preload=True, memmap_dir=None):
     """
     :param loc: string denoting where raw file(s) may be found
     :param pattern: string to identify, match the correct file(s)
-    :param concat: boolean keyword argument to turn on/off raw file concatenation (default True)
+    :param preload: boolean, False reads data from disk only when accessed
+    :param memmap_dir: string denoting a local directory whose memory-mapped files back the preloaded data, so only
+    the blocks being worked on stay resident; None keeps the data in RAM (see remove_memmaps)
     :return: pre-loaded raw .fif file(s)
     """
     list_of_raws = find_file_matches(loc, pattern)
+    if preload and memmap_dir:
+        makedirs(memmap_dir, exist_ok=True)
+        preloads = [join(memmap_dir, f'{getpid()}_{fif}.dat') for fif in list_of_raws]
+    else:
+        preloads = [preload] * len(list_of_raws)
     try:
-        raws = [mne.io.read_raw_fif(join(loc, fif), preload=True) for fif in list_of_raws]
+        raws = [mne.io.read_raw_fif(join(loc, fif), preload=fif_preload) for fif, fif_preload in zip(list_of_raws, preloads)]
     except TypeError:
         logging.info('Raw files failed to be read')
     return raws
 
 
+def concatenate_raws_virtually(loc, pattern, preload=False, memmap_dir=None):
+    """
+    present multiple runs as one continuous recording without copying them: runs are opened lazily and MNE serves
+    sample ranges straight from the run files, with boundary annotations at the run joins
+    :param loc: string denoting where raw file(s) may be found
+    :param pattern: string to identify, match the correct file(s)
+    :param preload: boolean, True loads the concatenated recording once into a single buffer (per-run arrays are
+    never allocated)
+    :param memmap_dir: string denoting a local directory whose memory-mapped file backs the preloaded buffer
+    :return: concatenated raw
+    """
+    raws = preload_raws(loc, pattern, preload=False)
+    if preload and memmap_dir:
+        makedirs(memmap_dir, exist_ok=True)
+        preload = join(memmap_dir, f'{getpid()}_{pattern.replace("*", "")}_concatenated.dat')
+    return mne.concatenate_raws(raws, preload=preload)
+
+
+def remove_memmaps(memmap_dir):
+    """ remove the memory-mapped data files this process created through preload_raws"""
+    if not memmap_dir or not isdir(memmap_dir):
+        return
+    for memmap_fname in fnmatch.filter(listdir(memmap_dir), f'{getpid()}_*.dat'):
+        remove(join(memmap_dir, memmap_fname)) # mapped pages stay valid until the raw objects are released
+    try:
+        rmdir(memmap_dir) # only removed once empty, no other process is using it
+    except OSError:
+        pass
+
+
+def write_config_manifest(save_loc, manifest_fname, *config_modules):
+    """
+    write the configuration values of a run to a single manifest
+    :param manifest_fname: string of the manifest's filename
+    :param config_modules: configuration modules whose public values are written
+    """
+    with open(join(save_loc, manifest_fname), 'w') as manifest:
+        for config_module in config_modules:
+            manifest.write(f'### {config_module.__name__}\n')
+            for var_name, value in vars(config_module).items():
+                if var_name.startswith('_') or callable(value) or inspect.ismodule(value):
+                    continue
+                manifest.write(f'{var_name}: {value}\n')
+    logging.info(f'Run configuration written to {join(save_loc, manifest_fname)}')
+
+
 def get_subject_id_from_data(data):
     """
     :param data: MNE object like raw, epochs, tfr,... that has an Info attribute
@@ -146,6 +203,119 @@ def save_epochs(epochs, condition_name, save_loc, epoch_pattern, overwrite=True)
     epochs.save(join(save_loc, epoch_fname), overwrite=overwrite)
 
 
+def save_drop_log(drop_log, save_loc, drop_log_fname):
+    """ save the epoch rejection thresholds and dropped events"""
+    with open(join(save_loc, drop_log_fname), 'w') as drop_log_file:
+        json.dump(drop_log, drop_log_file, indent=1)
+
+
+def save_epoch_store(epochs, conditions_indices, save_loc, store_name, chunk_size=64, dtype=np.float32):
+    """
+    save epochs once in a directory store: a memory-mappable data array, events, info and index tables that map each
+    condition/channel type onto the stored trials/channels, so trials shared between conditions are written once
+    :param epochs: preloaded epochs holding every trial of every condition
+    :param conditions_indices: dictionary whose keys are condition names, values are indices into epochs
+    :param store_name: string of the store's directory name
+    :param chunk_size: number of trials written to disk at a time
+    :param dtype: on-disk data type (single precision, as in epochs .fif files)
+    """
+    store_loc = join(save_loc, store_name)
+    check_and_build_subdir(store_loc)
+    data = epochs.get_data()
+    store_data = np.lib.format.open_memmap(join(store_loc, 'data.npy'), mode='w+', dtype=dtype, shape=data.shape)
+    for start in range(0, len(data), chunk_size):
+        store_data[start:start + chunk_size] = data[start:start + chunk_size]
+    store_data.flush()
+    del store_data
+
+    np.save(join(store_loc, 'events.npy'), epochs.events)
+    mne.io.write_info(join(store_loc, 'epochs-info.fif'), epochs.info)
+    ch_types_indices = {'mag': mne.pick_types(epochs.info, meg='mag', exclude=[]),
+                        'grad': mne.pick_types(epochs.info, meg='grad', exclude=[]),
+                        'meg': mne.pick_types(epochs.info, meg=True, exclude=[]),
+                        'eeg': mne.pick_types(epochs.info, meg=False, eeg=True, exclude=[])}
+    index = {'tmin': epochs.tmin, 'event_id': epochs.event_id,
+             'conditions': {condition: np.asarray(indices).tolist() for condition, indices in conditions_indices.items()},
+             'ch_types': {ch_type: indices.tolist() for ch_type, indices in ch_types_indices.items() if len(indices)}}
+    with open(join(store_loc, 'index.json'), 'w') as index_file:
+        json.dump(index, index_file)
+    logging.info(f'Saved {len(data)} epochs of {len(conditions_indices)} conditions to {store_loc}')
+
+
+def read_epoch_store(loc, store_name):
+    """
+    :param loc: string denoting where the epoch store is found
+    :param store_name: string of the store's directory name
+    :return: dictionary of the store's memory-mapped data, events, info and index tables (nothing is loaded yet)
+    """
+    store_loc = join(loc, store_name)
+    with open(join(store_loc, 'index.json')) as index_file:
+        store = json.load(index_file)
+    store['data'] = np.load(join(store_loc, 'data.npy'), mmap_mode='r')
+    store['events'] = np.load(join(store_loc, 'events.npy'))
+    store['info'] = mne.io.read_info(join(store_loc, 'epochs-info.fif'), verbose=False)
+    return store
+
+
+def get_epoch_store_data(store, condition=None, ch_type=None):
+    """
+    :param store: dictionary returned by read_epoch_store
+    :param condition: string condition name, None for all trials
+    :param ch_type: string channel type ('mag', 'grad', 'meg', 'eeg'), None for all channels
+    :return: memory-mapped view of the whole store, or an array holding only the selected trials/channels
+    """
+    data = store['data']
+    if condition is not None and ch_type is not None:
+        return data[np.ix_(store['conditions'][condition], store['ch_types'][ch_type])]
+    if condition is not None:
+        return data[store['conditions'][condition]]
+    if ch_type is not None:
+        return data[:, store['ch_types'][ch_type]]
+    return data
+
+
+def read_epochs_from_store(store, condition, ch_type=None):
+    """
+    :param store: dictionary returned by read_epoch_store
+    :param condition: string condition name
+    :param ch_type: string channel type ('mag', 'grad', 'meg', 'eeg'), None for all channels
+    :return: epochs of a single condition, reading only its trials from disk
+    """
+    trial_indices = store['conditions'][condition]
+    info = store['info'] if ch_type is None else mne.pick_info(store['info'], store['ch_types'][ch_type])
+    events = store['events'][trial_indices]
+    event_id = {name: value for name, value in store['event_id'].items() if value in events[:, 2]}
+    # stored data are already baseline corrected and projected
+    return mne.EpochsArray(get_epoch_store_data(store, condition, ch_type), info, events=events, tmin=store['tmin'],
+                           event_id=event_id, baseline=None)
+
+
+def save_tfr(path, tfr):
+    tfr.save(path, overwrite=True)
+
+
+def read_tfr(path):
+    return mne.time_frequency.read_tfrs(path)[0]
+
+
+def save_arrays(path, arrays):
+    """ save a dictionary of arrays to a single .npz file"""
+    np.savez(path, **arrays)
+
+
+def read_arrays(path):
+    with np.load(path) as arrays_file:
+        return dict(arrays_file)
+
+
+def save_table(rows, header, save_loc, table_fname):
+    """ save rows of values as a CSV table"""
+    with open(join(save_loc, table_fname), 'w', newline='') as table_file:
+        table_writer = csv.writer(table_file)
+        table_writer.writerow(header)
+        table_writer.writerows(rows)
+
+
 def read_bad_channels_eeg(loc, eeg_bads_fname):
     eeg_bads_txt = open(join(loc, eeg_bads_fname))
     lines = eeg_bads_txt.readlines()
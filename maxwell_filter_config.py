@@ -14,9 +14,18 @@ regularize = 'in'
 sss_params = {'calibration': cal, 'cross_talk': ctc,
               'int_order': int_order, 'ext_order': ext_order, 'st_duration': st_dur,
               'st_correlation': st_corr, 'coord_frame': coord_frame, 'regularize': regularize}
-
-sss_vars_output_filename = f'{para_cfg.paradigm}_sss_config_variables_output_{para_cfg.current_datetime}.txt'
-with open(join(para_cfg.paradigm_dir, sss_vars_output_filename), 'w+') as var_output:
-    for var_name, value in dict(vars()).items():
-        var_output.write(f'{var_name}: {value}\n')
-var_output.close()
\ No newline at end of file
+# SSS basis/pseudo-inverse cache shared by bad channel detection, paradigm and ERM SSS (None to disable)
+sss_basis_cache_dir = join(para_cfg.paradigm_dir, 'sss_basis_cache')
+# SSS'd ERMs shared by every paradigm measured on the same date, one per distinct set of bad channels
+erm_sss_cache_dir = join(para_cfg.meg_dir, 'erm_sss_cache')
+# opt-in: stream SSS over chunks read from disk (peak memory ~ chunk length), chunks follow maxwell_filter's tSSS windows
+# of each run and up to sss_max_jobs of them are filtered in parallel; the default (False) runs maxwell_filter serially
+# on the whole recording, as streaming is not yet verified on multi-run, movement compensated data
+sss_streaming = False
+# with sss_streaming, also run maxwell_filter on the whole recording and fail if the streamed output differs by more than
+# the tolerance; keep on until the streamed output has been verified on the paradigm's recordings
+sss_verify_streaming = True
+sss_verify_tolerance = 1e-6 # relative to the largest absolute value per channel type
+sss_chunk_duration = st_dur * 6 if st_dur else 60.
+chpi_chunk_duration = 60. # seconds of cHPI data fitted per parallel job
+sss_max_jobs = 4 # at most this many chunks (taken from the n_jobs budget) are filtered at once
@@ -4,38 +4,105 @@ import mne
 import io_helpers as i_o
 import preprocessing as preproc
 import maxwell_filter_config as sss_cfg
+import stage_cache as cache
+import sss_cache
 import os
+import sys
+import shutil
 from os.path import join, exists
 
 
-def handle_erm(info, subject_erm_dir, raw_erm_fname, erm_sss_pattern): # return ERM file locations, directory information
+def link_or_copy(src, dst):
+    """ make dst point to src, copying where the filesystem does not support symbolic links"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.symlink(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def find_erm_paths(info, subject_erm_dir, raw_erm_pattern):
+    """
+    :param info: MNE Info object of the paradigm recording, used for its measurement date
+    :return: string of the measurement date
+    :return: list of strings of the full paths of the subject's ERM runs of that date
+    """
     date_paradigm = i_o.read_measure_date(info)
     subject_erm_date_dir = join(subject_erm_dir, date_paradigm)
+    raw_erm_fnames = i_o.find_file_matches(subject_erm_date_dir, raw_erm_pattern) if os.path.isdir(subject_erm_date_dir) else []
+    return date_paradigm, [join(subject_erm_date_dir, raw_erm_fname) for raw_erm_fname in raw_erm_fnames]
+
 
-    raw_erm = i_o.preload_raws(subject_erm_date_dir, raw_erm_fname) # load the raw ERM data
-    erm_sss_fname = i_o.format_variable_names({'date': date_paradigm}, erm_sss_pattern) # ***** check filenaming_config for redundancy
-    return raw_erm, erm_sss_fname
+def process_erm(info, subject, subject_erm_dir, raw_erm_pattern, bads, sss_params, subject_preproc_dir, erm_sss_fname):
+    """
+    SSS the subject's ERM of the measurement date once per distinct set of bad channels, shared by every paradigm
+    recorded that day; the paradigm's ERM file links to the shared result
+    :param info: MNE Info object of the paradigm recording, used for its measurement date
+    :param bads: list of strings of the paradigm's bad MEG channels
+    :param sss_params: dictionary containing the paradigm's SSS/maxwell filtering parameters
+    :return: string of the full path to the shared SSS'd ERM, None if no ERM was found
+    """
+    date_paradigm, raw_erm_paths = find_erm_paths(info, subject_erm_dir, raw_erm_pattern)
+    subject_erm_date_dir = join(subject_erm_dir, date_paradigm)
+    if not raw_erm_paths:
+        logging.info(f'No ERM recording found in {subject_erm_date_dir}')
+        return
 
+    # head position related parameters are replaced for ERM processing, they do not change the result
+    erm_params = {key: value for key, value in sss_params.items() if key not in ['destination', 'head_pos', 'origin']}
+    erm_key = cache.hash_params({'bads': sorted(set(bads)), 'sss_params': erm_params,
+                                 'raw_erm': cache.hash_file_stats(raw_erm_paths)})[:12]
+    erm_cache_dir = join(sss_cfg.erm_sss_cache_dir, subject, date_paradigm)
+    os.makedirs(erm_cache_dir, exist_ok=True)
+    erm_cache_fname = f'{subject}_erm_{date_paradigm}_{erm_key}_raw_sss.fif'
 
-def handle_multiple_runs(raws, subject_sss_params, subject_fnames, subject_paradigm_dir):
+    if exists(join(erm_cache_dir, erm_cache_fname)):
+        logging.info(f'Reusing SSS\'d ERM {erm_cache_fname}')
+    else:
+        raw_erm = i_o.concatenate_raws_virtually(subject_erm_date_dir, raw_erm_pattern) # maxwell_filter loads it once
+        erm_tmp_fname = erm_cache_fname.replace('raw_sss.fif', f'{os.getpid()}_tmp_raw_sss.fif')
+        preproc.mne_maxwell_filter_erm(raw_erm, bads, sss_params, erm_cache_dir, erm_tmp_fname)
+        os.replace(join(erm_cache_dir, erm_tmp_fname), join(erm_cache_dir, erm_cache_fname)) # other paradigms may race
+    link_or_copy(join(erm_cache_dir, erm_cache_fname), join(subject_preproc_dir, erm_sss_fname))
+    return join(erm_cache_dir, erm_cache_fname)
 
-    sss_list = []
-    bads_list = []
-    if raws[0].info['dev_head_t'] is None:
+
+def handle_multiple_runs(raw_concat, subject_sss_params, subject_fnames, subject_paradigm_dir, run_paths):
+    """
+    :param raw_concat: all runs concatenated (see i_o.concatenate_raws_virtually), its info is that of run #1
+    :param run_paths: list of strings of the runs' full paths, in concatenation order
+    """
+    if raw_concat.info['dev_head_t'] is None:
         return
-    subject_sss_params['destination'] = raws[0].info['dev_head_t'] # use run #1 for head position transformation
-    raw_concat = mne.concatenate_raws(raws)
+    subject_sss_params['destination'] = raw_concat.info['dev_head_t'] # use run #1 for head position transformation
     if len(raw_concat.info['dig']) < 8:
         return
     subject_sss_params['origin'] = preproc.generate_head_origin(raw_concat.info, subject_paradigm_dir,
                                                                   subject_fnames['head_origin'])
     subject_sss_params['head_pos'] = preproc.calc_head_position(raw_concat, subject_fnames['preproc_subdir'],
-                                                                  subject_fnames['head_pos'])
-    bads_meg = preproc.find_bads_meg(raw_concat, subject_sss_params, subject_fnames['preproc_subdir'],
-                                     subject_fnames['meg_bads'], para_cfg.n_jobs)
+                                                                  subject_fnames['head_pos'], run_paths, para_cfg.n_jobs,
+                                                                  sss_cfg.chpi_chunk_duration)
+    if sss_cfg.sss_streaming: # the whole recording is never loaded at once
+        bads_meg = preproc.find_bads_meg_chunked(raw_concat, subject_sss_params, sss_cfg.sss_chunk_duration,
+                                                 subject_fnames['preproc_subdir'], subject_fnames['meg_bads'])
+    else:
+        bads_meg = preproc.find_bads_meg(raw_concat, subject_sss_params, subject_fnames['preproc_subdir'],
+                                         subject_fnames['meg_bads'], para_cfg.n_jobs)
     raw_concat.info['bads'].extend(bads_meg)
-    sss = mne.preprocessing.maxwell_filter(raw_concat, **subject_sss_params)
-    sss.save(join(subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm']), overwrite=True)
+    if sss_cfg.sss_streaming: # runs are read lazily, filter chunk by chunk from disk
+        preproc.mne_maxwell_filter_chunked(raw_concat, subject_sss_params, sss_cfg.sss_chunk_duration,
+                                           subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm'],
+                                           min(para_cfg.n_jobs, sss_cfg.sss_max_jobs), sss_cfg.sss_basis_cache_dir,
+                                           para_cfg.sss_basis_memory_entries)
+        if sss_cfg.sss_verify_streaming:
+            relative_diff = preproc.compare_sss_outputs(raw_concat, subject_sss_params,
+                                                        join(subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm']))
+            if any(diff > sss_cfg.sss_verify_tolerance for diff in relative_diff.values()):
+                raise ValueError(f'Streamed SSS differs from maxwell_filter on the whole recording: {relative_diff}')
+    else: # default: serial tSSS over the whole recording
+        sss = mne.preprocessing.maxwell_filter(raw_concat, **subject_sss_params)
+        sss.save(join(subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm']), overwrite=True)
     return bads_meg
 
 
@@ -45,15 +112,40 @@ def main(subject, subject_fnames, log):
     subject_paradigm_dir = join(para_cfg.paradigm_dir, subject)
     subject_paradigm_visit_dir = join(subject_paradigm_dir, f"visit_{subject_fnames['meg_date']}")
     subject_erm_dir = join(para_cfg.erm_dir, subject)
-    subject_sss_params = sss_cfg.sss_params # load SSS parameters dictionary
+    subject_sss_params = sss_cfg.sss_params.copy() # load SSS parameters dictionary, copied as it is filled per subject
 
     i_o.check_and_build_subdir(subject_fnames['preproc_subdir']) # check and/or build subject subdirectories relevant to the script
 
-    
-    if not exists(join(subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm'])):
-        raws = i_o.preload_raws(subject_paradigm_visit_dir, subject_fnames['raw_paradigm'])
-        bads_list = handle_multiple_runs(raws, subject_sss_params, subject_fnames, subject_paradigm_dir)
+    # re-run SSS only if the raw runs, SSS parameters or code changed since the saved output was made
+    raw_fnames = i_o.find_file_matches(subject_paradigm_visit_dir, subject_fnames['raw_paradigm'])
+    sss_inputs = [join(subject_paradigm_visit_dir, raw_fname) for raw_fname in raw_fnames]
+    sss_inputs.extend([sss_file for sss_file in [sss_cfg.cal, sss_cfg.ctc] if exists(sss_file)])
+    if para_cfg.proc_using_erm and raw_fnames: # the ERM runs of the measurement date are SSS'd in this stage too
+        first_run_info = mne.io.read_info(join(subject_paradigm_visit_dir, raw_fnames[0]), verbose=False)
+        sss_inputs.extend(find_erm_paths(first_run_info, subject_erm_dir, subject_fnames['raw_erm'])[1])
+    sss_fingerprint = cache.fingerprint_stage(sss_inputs, {'sss_params': subject_sss_params,
+                                                           'sss_streaming': sss_cfg.sss_streaming,
+                                                           'sss_chunk_duration': sss_cfg.sss_chunk_duration,
+                                                           'proc_using_erm': para_cfg.proc_using_erm,
+                                                           'raw_erm': subject_fnames['raw_erm']},
+                                              [sys.modules[__name__], preproc, i_o])
+    if cache.is_stage_current(subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm'], sss_fingerprint):
+        return
+
+    if sss_cfg.sss_basis_cache_dir: # reused by bad channel detection, paradigm and ERM SSS
+        sss_cache.enable_sss_basis_cache(sss_cfg.sss_basis_cache_dir, para_cfg.sss_basis_memory_entries)
+    memmap_dir = subject_fnames['raw_memmap_subdir'] if para_cfg.raw_memmap else None
+    try:
+        raw_concat = i_o.concatenate_raws_virtually(subject_paradigm_visit_dir, subject_fnames['raw_paradigm'],
+                                                    preload=not sss_cfg.sss_streaming, memmap_dir=memmap_dir)
+        bads_list = handle_multiple_runs(raw_concat, subject_sss_params, subject_fnames, subject_paradigm_dir,
+                                         [join(subject_paradigm_visit_dir, raw_fname) for raw_fname in raw_fnames])
+    finally: # memmaps are removed even when the visit fails
+        i_o.remove_memmaps(memmap_dir)
+    if bads_list is None: # SSS could not be performed (no head transformation or digitization)
+        return
 
     if para_cfg.proc_using_erm:
-        raw_erm, erm_sss_fname = handle_erm(raws[0].info, subject_erm_dir, subject_fnames['raw_erm'], subject_fnames['sss_erm'])
-        erm_sss = preproc.mne_maxwell_filter_erm(raw_erm, bads_list, subject_sss_params, subject_fnames['preproc_subdir'], erm_sss_fname)
+        process_erm(raw_concat.info, subject, subject_erm_dir, subject_fnames['raw_erm'], bads_list, subject_sss_params,
+                    subject_fnames['preproc_subdir'], subject_fnames['sss_erm'])
+    cache.record_stage(subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm'], sss_fingerprint)
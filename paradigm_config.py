@@ -15,14 +15,21 @@ subjects_dir = join(transcend_dir, 'MRI', 'WMA', 'recons') # MRI directory - rec
 
 shared_func_dir = join(transcend_dir, 'scripts')
 
-n_jobs = max(cpu_count() - 4, 1)
+n_jobs = max(cpu_count() - 4, 1) # global core budget, split between subject workers when running in parallel
+n_subject_workers = 1 # number of subject/visit jobs processed at once (1 -> serial)
+sss_basis_memory_entries = 32 # SSS basis decompositions (~0.7 MB each) kept in memory by each subject/chunk worker
+n_render_workers = 2 # background processes rendering figures while the stages keep computing (0 -> inline)
+# back preloaded raw data with memory-mapped files in the visit's raw_memmap directory, on disk rather than a tmpfs
+# that would hold them in RAM anyway (False keeps raw data in RAM)
+raw_memmap = True
 
 ### MID LEVEL ### paradigm-relevant parameters, variables...
 paradigm = 'ASSRnew_Jumps'
 paradigm_dir = join(meg_dir, paradigm)
-paradigm_vars_output_filename = f'{paradigm}_paradigm_config_variables_output_{current_datetime}.txt'
+run_manifest_fname = f'{paradigm}_run_manifest_{current_datetime}.txt' # every config value of the run, see paradigm_wrapper
 
 reports_dir = join(paradigm_dir, 'reports')
+fs_index_path = join(reports_dir, f'{paradigm}_fs_index.json') # directory listings kept between runs
 
 
 # noise covariance matrix, inverse computation done by using either baseline period or ERM
@@ -33,6 +40,15 @@ proc_using_erm = False if proc_using_baseline else True
 # bandpass filtering
 l_freq = 0.1
 h_freq = 144.
+# apply the bandpass and line noise notches (all harmonics up to Nyquist) in one blocked FFT pass; checked against
+# raw.filter + raw.notch_filter on the first seconds of each recording, filtered in two passes beyond the tolerance
+fused_filter = False
+fused_filter_tolerance = 1e-6 # maximum error relative to the largest filtered value
+notch_ch_types = ['eeg'] # channel types whose line noise is notched in the fused pass
+# set the EEG montage and average reference, mark bad EEG channels (RANSAC) and notch filter EEG after bandpass filtering
+process_eeg = False
+# decimate the filtered signal (and its events) by the largest factor keeping h_freq and freqs alias-free
+decimate = False
 
 # merged/specified/grouped event IDs, conditions
 # key <-> condition name
@@ -71,20 +87,33 @@ epoch_reject = dict(grad=grad_epoch_reject, mag=mag_epoch_reject, eeg=eeg_epoch_
 epochs_parameters_dict = {'tmin': epoch_tmin, 'tmax': epoch_tmax,
                           'baseline': epoch_baseline, 'proj': epoch_proj,
                           'reject': None}
+# learn per channel type peak-to-peak rejection thresholds from the data instead of the fixed epoch_reject values
+epoch_reject_learned = False
+# save epochs once in a shared, memory-mappable store with per-condition index tables instead of one .fif per condition
+epoch_store = False
 
 # parameters dictionary for windowing power/ITC, include modes like 'mean', 'max'...
 freqs = arange(15, 50, 2) # frequencies of interest
 n_cycles = freqs / 2.  # different number of cycles per frequency
 n_cycles[freqs < 15] = 2
+# compute the wavelet transform once over the union of all conditions' trials (requires epoch_store)
+shared_trial_tfr = True
+# spectra of every trial, averaged per condition: 'welch' or 'multitaper'
+psd_method = 'welch'
 
 # sensor power/ITC windowing parameters
 tfr_t_start = 0.1
 tfr_t_end = 0.9
 tfr_temporal_dict = {'t_start':tfr_t_start, 't_end': tfr_t_end}
+# single precision wavelet convolution of the shared trial TFR, checked against MNE's float64 result on a few trials
+tfr_float32 = True
+tfr_tolerance = 1e-3 # maximum error relative to the largest coefficient, float64 is used beyond it
+tfr_decim = 'auto' # integer TFR output decimation, 'auto' chooses it from freqs.max()
+tfr_crop = None # (tmin, tmax) of the TFR kept, ex: (tfr_t_start, tfr_t_end), None keeps the whole epoch
+# time-frequency windows summarized from each power/ITC TFR into one table per condition
+tfr_windows = [{'name': 'onset', 'tmin': 0., 'tmax': 0.2, 'fmin': freqs.min(), 'fmax': freqs.max()},
+               {'name': 'sustained', 'tmin': tfr_t_start, 'tmax': tfr_t_end, 'fmin': freqs.min(), 'fmax': freqs.max()},
+               {'name': 'offset', 'tmin': tfr_t_end, 'tmax': tfr_t_end + 0.3, 'fmin': freqs.min(), 'fmax': freqs.max()}]
+tfr_reductions = ['mean', 'max', 'peak_latency']
 
 sensor_report_fname = f'sensor_space_{paradigm}_{current_datetime}_report.h5' # sensor space report filename
-
-with open(join(paradigm_dir, paradigm_vars_output_filename), 'w+') as var_output:
-    for var_name, value in dict(vars()).items():
-        var_output.write(f'{var_name}: {value}\n')
-var_output.close()
@@ -1,13 +1,18 @@
 import filenaming_config as fname_cfg
 import paradigm_config as paradigm_cfg
-from mnepy_sss import main as maxwell_main
-from epoching import main as epochs_main
-from sensor_space_analysis import main as sensor_tfr_main
-from mne import open_report, Report
-from io_helpers import check_and_build_subdir
-from os import listdir, walk
+import maxwell_filter_config as sss_cfg
+import artifact_removal_config as rm_arti_cfg
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import fs_index
+from os import makedirs, environ
+from time import time
+import logging
+import traceback
+import sys
 import os.path as op
 
+heavy_modules = ('mne', 'scipy', 'matplotlib') # loaded by the stage modules, never by importing the wrapper
+
 
 def run_if_needed(function, subject, subject_filenaming_dict, log_name, override=True):
     """ runs the supplied script if necessary"""
@@ -17,6 +22,10 @@ def run_if_needed(function, subject, subject_filenaming_dict, log_name, override
 
 def run_subject(subject, subject_filenaming_dict):
     """ process a single subject"""
+    # stage modules (and MNE with them) are imported by the first subject processed in this process
+    from mnepy_sss import main as maxwell_main
+    from epoching import main as epochs_main
+    from sensor_space_analysis import main as sensor_tfr_main
     # maxwell filtering script
     run_if_needed(maxwell_main, subject, subject_filenaming_dict,
                   fname_cfg.maxwell_script_log_name, override=False)
@@ -28,30 +37,151 @@ def run_subject(subject, subject_filenaming_dict):
                   fname_cfg.sensor_space_script_log_name, override=False)
 
 
-def run_subjects():
-    """ process all subjects in the paradigm directory"""
-    for subject_folder_path, directory_names, filenames in walk(paradigm_cfg.paradigm_dir):
-        path_identification = op.split(subject_folder_path)
-        if 'visit' not in path_identification[1]:
-            continue
-        #if len(filenames) == 0:
-        #    continue
+def find_subject_visits():
+    """ list the subject/visit folders of the paradigm directory
+    :return: list of (subject, visit folder) tuples to process
+    """
+    return fs_index.scan_subject_visits(paradigm_cfg.paradigm_dir)
+
+
+def get_expected_outputs(subject, visit_folder):
+    """
+    :return: dictionary whose keys are a subject/visit's stage outputs, values are (directory, filename pattern) tuples
+    """
+    subject_fnames = fname_cfg.create_paradigm_subject_mapping(subject, visit_folder)
+    epochs_pattern = subject_fnames['epoch_store'] if paradigm_cfg.epoch_store else \
+        subject_fnames['epoch'].replace('condition', '*')
+    return {'raw': (op.join(paradigm_cfg.paradigm_dir, subject, visit_folder), subject_fnames['raw_paradigm']),
+            'sss': (subject_fnames['preproc_subdir'], subject_fnames['sss_paradigm']),
+            'epochs': (subject_fnames['epochs_subdir'], epochs_pattern),
+            'sensor_psd': (subject_fnames['epochs_sensor_subdir'], subject_fnames['sensor_psd'])}
+
+
+def get_run_logger():
+    """ :return: logger of the whole run, writing to the reports directory (subject jobs replace the root handlers)"""
+    run_logger = logging.getLogger('paradigm_run')
+    if not run_logger.handlers:
+        makedirs(paradigm_cfg.reports_dir, exist_ok=True)
+        run_logger.addHandler(logging.FileHandler(op.join(paradigm_cfg.reports_dir, fname_cfg.run_summary_log_name)))
+        run_logger.setLevel(logging.INFO)
+        run_logger.propagate = False
+    return run_logger
 
-        visit_folder = path_identification[1]
-        print(path_identification)
-        if len(visit_folder.split('_')[1]) != 8:
-            continue
-        subject = op.split(path_identification[0])[1]  # split the path again to obtain the subject ID
 
-        print(subject)
-        print(visit_folder)
+def log_missing_outputs(subject_visits):
+    """ log which subject/visits are missing which stage outputs
+    :return: dictionary whose keys are (subject, visit folder) tuples, values are lists of missing output names
+    """
+    missing_outputs = fs_index.find_missing_outputs(subject_visits, get_expected_outputs)
+    summary = [f'{len(missing_outputs)} of {len(subject_visits)} subject visits are missing outputs']
+    summary.extend(f'{subject} {visit_folder}: {", ".join(missing)}'
+                   for (subject, visit_folder), missing in missing_outputs.items())
+    get_run_logger().info('\n'.join(summary))
+    return missing_outputs
 
-        subject_filename_dict = fname_cfg.create_paradigm_subject_mapping(subject, visit_folder)
+
+def run_subject_job(subject, visit_folder, n_jobs):
+    """ process a single subject/visit inside a worker process
+    :param n_jobs: this worker's share of the global core budget
+    :return: (subject, visit folder, error traceback or None, elapsed seconds)
+    """
+    paradigm_cfg.n_jobs = n_jobs # the stage scripts read n_jobs from the paradigm configuration
+
+    # route this job's logging to its own file in the visit's preprocessing directory, the stage scripts' basicConfig
+    # calls become no-ops
+    subject_filename_dict = fname_cfg.create_paradigm_subject_mapping(subject, visit_folder)
+    makedirs(subject_filename_dict['preproc_subdir'], exist_ok=True)
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+        handler.close()
+    job_handler = logging.FileHandler(op.join(subject_filename_dict['preproc_subdir'], fname_cfg.subject_job_log_name))
+    root_logger.addHandler(job_handler)
+    root_logger.setLevel(logging.DEBUG)
+
+    start = time()
+    try:
         run_subject(subject, subject_filename_dict)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+        logging.error(f'{subject} {visit_folder} failed:\n{error}')
+    finally:
+        root_logger.removeHandler(job_handler)
+        job_handler.close()
+    return subject, visit_folder, error, time() - start
+
+
+def init_subject_worker(n_threads):
+    """ limit a subject worker's BLAS/OpenMP threads to its share of the core budget, as n_jobs limits MNE's jobs"""
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        environ[variable] = str(n_threads) # read by the libraries loaded from now on
+    try:
+        from threadpoolctl import threadpool_limits # optional, limits the libraries already loaded (ex: numpy's BLAS)
+    except ImportError:
+        return
+    threadpool_limits(n_threads)
+
+
+def log_run_summary(results):
+    """ print and log which subject/visit jobs succeeded and which failed
+    :param results: list of (subject, visit folder, error traceback or None, elapsed seconds) tuples
+    """
+    failures = [result for result in results if result[2] is not None]
+    summary = [f'{len(results) - len(failures)} of {len(results)} subject/visit jobs succeeded']
+    for subject, visit_folder, error, elapsed in results:
+        status = 'FAILED' if error else 'ok'
+        summary.append(f'{status}: {subject} {visit_folder} ({elapsed:.0f} s)')
+    for subject, visit_folder, error, elapsed in failures:
+        summary.append(f'{subject} {visit_folder} traceback:\n{error}')
+    print('\n'.join(summary))
+    get_run_logger().info('\n'.join(summary))
+
+
+def run_subjects(n_workers=None):
+    """ process all subjects in the paradigm directory
+    :param n_workers: number of subject/visit jobs run at once, defaults to paradigm_cfg.n_subject_workers
+    """
+    n_workers = paradigm_cfg.n_subject_workers if n_workers is None else n_workers
+    fs_index.load_index(paradigm_cfg.fs_index_path)
+    subject_visits = find_subject_visits()
+    log_missing_outputs(subject_visits)
+    results = []
+    if n_workers <= 1: # same job isolation and summary as the workers, in this process
+        for subject, visit_folder in subject_visits:
+            results.append(run_subject_job(subject, visit_folder, paradigm_cfg.n_jobs))
+        log_run_summary(results)
+        fs_index.save_index(paradigm_cfg.fs_index_path)
+        return
+
+    worker_n_jobs = max(paradigm_cfg.n_jobs // n_workers, 1) # split the core budget between the workers
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_subject_worker,
+                             initargs=(worker_n_jobs,)) as executor:
+        futures = {executor.submit(run_subject_job, subject, visit_folder, worker_n_jobs): (subject, visit_folder)
+                   for subject, visit_folder in subject_visits}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception: # the worker process itself died (ex: out of memory)
+                subject, visit_folder = futures[future]
+                results.append((subject, visit_folder, traceback.format_exc(), 0.))
+    log_run_summary(results)
+    fs_index.save_index(paradigm_cfg.fs_index_path) # workers' listings are not shared, directories changed are re-listed
+
+
+def find_heavy_imports():
+    """ :return: list of the heavy modules already imported, checked before the wrapper uses any of them"""
+    return [module for module in heavy_modules if module in sys.modules]
 
 
 if __name__ == "__main__":
+    heavy_imports = find_heavy_imports()
+    if heavy_imports:
+        logging.warning(f'Importing the paradigm wrapper loaded {", ".join(heavy_imports)}, worker start-up is slowed')
+    from io_helpers import check_and_build_subdir, write_config_manifest
+    from report_builder import build_sensor_space_report
     check_and_build_subdir(paradigm_cfg.reports_dir)
-    sensor_report = Report()
+    write_config_manifest(paradigm_cfg.paradigm_dir, paradigm_cfg.run_manifest_fname,
+                          paradigm_cfg, fname_cfg, sss_cfg, rm_arti_cfg) # once per run, not on every config import
     run_subjects()
-    sensor_report.save(op.join(paradigm_cfg.reports_dir, paradigm_cfg.sensor_report_fname.replace('h5', 'html')))
+    build_sensor_space_report(paradigm_cfg.reports_dir, paradigm_cfg.sensor_report_fname) # rendered once, at the end
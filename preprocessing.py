@@ -1,54 +1,218 @@
 import mne
 import logging
-import autoreject
+import hashlib
 import numpy as np
+import scipy.fft
+import scipy.stats
 import io_helpers as i_o
 import visuals as vis
-from os.path import join, exists
+import sss_cache
+import stage_cache
+import os
+from os.path import join, exists, basename
 
 
-def apply_notch_filter_to_eeg(raw, n_jobs, loc, eeg_bads_fname, epochs_parameters_dict):
+def apply_notch_filter_to_eeg(raw, n_jobs, loc, eeg_bads_fname, epochs_parameters_dict, events=None):
     """
     :param raw: raw file to notch filter
     :param n_jobs: job control for speeding up computation
     :param loc: string of location to read bad EEG channels from, required to do so before notch filtering
     :param eeg_bads_fname: string of subject+paradigm specific bad EEG channels filename
+    :param events: already found events, passed on to the bad EEG channel detection
     :return: notch filtered raw fif file
     """
     linefreq = raw.info['line_freq'] # notch filter line frequency
-    raw = find_bads_eeg(raw, epochs_parameters_dict, n_jobs, loc, eeg_bads_fname) # find and add bad EEG channels
+    raw = find_bads_eeg(raw, epochs_parameters_dict, n_jobs, loc, eeg_bads_fname, events) # find and add bad EEG channels
     for harmonic_num in [1, 2]: # notch filter its second harmonic, too
         notch_freq = linefreq * harmonic_num
         raw.notch_filter(np.arange(notch_freq, 241, notch_freq), picks=['eeg'], n_jobs=n_jobs)
     return raw
 
 
+def design_fused_filter(sfreq, l_freq, h_freq, notch_freqs, n_times, notch_trans_bandwidth=1.):
+    """
+    design the bandpass and the line noise notches as zero-phase frequency responses over a shared FFT length
+    :param notch_freqs: list of frequencies to notch (empty for the bandpass only)
+    :param n_times: number of samples of the signal the responses are applied to
+    :return: list of (frequency response over the rfft bins of n_fft, number of samples each side is padded with)
+    :return: n_fft
+    """
+    firs = [mne.filter.create_filter(None, sfreq, l_freq, h_freq, fir_design='firwin', verbose=False)]
+    if len(notch_freqs):
+        notch_widths = np.asarray(notch_freqs) / 200. # band-stop edges as in mne.filter.notch_filter
+        trans_half = notch_trans_bandwidth / 2.
+        lows = np.asarray(notch_freqs) - notch_widths / 2. - trans_half
+        highs = np.asarray(notch_freqs) + notch_widths / 2. + trans_half
+        firs.append(mne.filter.create_filter(None, sfreq, highs, lows, l_trans_bandwidth=trans_half,
+                                             h_trans_bandwidth=trans_half, fir_design='firwin', verbose=False))
+    n_edges = [max(min(len(fir), n_times) - 1, 0) for fir in firs] # as mne.filter._overlap_add_filter
+    n_fft = scipy.fft.next_fast_len(n_times + 2 * max(n_edges))
+    responses = []
+    for fir, n_edge in zip(firs, n_edges): # centre each symmetric FIR on sample 0, its spectrum is then its zero-phase response
+        center = len(fir) // 2
+        fir_centered = np.zeros(n_fft)
+        fir_centered[:len(fir) - center] = fir[center:]
+        fir_centered[n_fft - center:] = fir[:center]
+        responses.append((np.fft.rfft(fir_centered).real, n_edge))
+    return responses, n_fft
+
+
+def pad_reflect_limited(block, n_edge):
+    """ odd reflection of each channel about its first and last samples, zero beyond the signal's length, as MNE's
+    'reflect_limited' filter padding"""
+    n_times = block.shape[1]
+    zeros = np.zeros((block.shape[0], max(n_edge - n_times + 1, 0)), block.dtype)
+    return np.concatenate([zeros, 2 * block[:, :1] - block[:, n_edge:0:-1], block,
+                           2 * block[:, -1:] - block[:, -2:-n_edge - 2:-1], zeros], axis=1)
+
+
+def fused_filter_signal(raw, l_freq, h_freq, notch_ch_types, block_size=8):
+    """
+    bandpass filter all data channels and notch line noise harmonics (up to Nyquist) on notch_ch_types channels,
+    applying every filter to a block of channels before moving to the next block, so the data are traversed once;
+    each filter pads the signal as MNE does, so the result matches raw.filter followed by raw.notch_filter
+    :param raw: preloaded signal to filter in place
+    :param notch_ch_types: list of channel types to notch filter, ex: ['eeg']
+    :param block_size: number of channels filtered at once
+    :return: filtered signal
+    """
+    sfreq = raw.info['sfreq']
+    data_picks, notch_picks, line_harmonics = get_fused_filter_picks(raw.info, notch_ch_types)
+
+    for picks, notch_freqs in [(np.setdiff1d(data_picks, notch_picks), []), (notch_picks, line_harmonics)]:
+        if not len(picks):
+            continue
+        responses, n_fft = design_fused_filter(sfreq, l_freq, h_freq, notch_freqs, len(raw.times))
+        logging.info(f'Fused filter: {l_freq}-{h_freq} Hz bandpass, notches at {list(notch_freqs)} Hz, '
+                     f'{len(picks)} channels')
+
+        def filter_block(block):
+            for response, n_edge in responses:
+                spectrum = np.fft.rfft(pad_reflect_limited(block, n_edge), n_fft, axis=1)
+                spectrum *= response
+                block = np.fft.irfft(spectrum, n_fft, axis=1)[:, n_edge:n_edge + block.shape[1]]
+            return block
+
+        for block_start in range(0, len(picks), block_size):
+            raw.apply_function(filter_block, picks=picks[block_start:block_start + block_size], channel_wise=False)
+
+    mne.filter._filt_update_info(raw.info, True, l_freq, h_freq) # every data channel was filtered, as raw.filter
+    return raw
+
+
+def get_fused_filter_picks(info, notch_ch_types):
+    """
+    :return: indices of the data channels
+    :return: indices of the data channels whose line noise is notched
+    :return: line noise harmonics below Nyquist
+    """
+    data_picks = mne.pick_types(info, meg=True, eeg=True, seeg=True, ecog=True, exclude=[])
+    notch_picks = np.intersect1d(data_picks, mne.pick_types(info, meg=False, exclude=[],
+                                                            **{ch_type: True for ch_type in notch_ch_types}))
+    line_freq = info['line_freq'] or 60.
+    line_harmonics = np.arange(line_freq, info['sfreq'] / 2. - line_freq / 100. - 1., line_freq) # stop bands below Nyquist
+    return data_picks, notch_picks, line_harmonics
+
+
+def check_fused_filter_tolerance(raw, l_freq, h_freq, notch_ch_types, n_jobs, tolerance, duration=30.):
+    """
+    compare the fused filter with raw.filter followed by raw.notch_filter on the first seconds of a few channels
+    :param raw: preloaded signal, not modified
+    :param tolerance: maximum error, relative to the largest filtered value
+    :param duration: seconds of signal compared, both ends of which are filter edges
+    :return: True if the fused filter is within tolerance
+    """
+    data_picks, notch_picks, line_harmonics = get_fused_filter_picks(raw.info, notch_ch_types)
+    check_picks = np.union1d(np.setdiff1d(data_picks, notch_picks)[:2], notch_picks[:2])
+    stop = min(int(round(duration * raw.info['sfreq'])), len(raw.times))
+    check_raw = mne.io.RawArray(raw.get_data(picks=check_picks, stop=stop), mne.pick_info(raw.info, check_picks),
+                                verbose=False) # only the compared channels and seconds are copied
+    reference = check_raw.copy().filter(l_freq, h_freq, n_jobs=n_jobs, verbose=False)
+    if len(notch_picks):
+        reference.notch_filter(line_harmonics, picks=notch_ch_types, n_jobs=n_jobs, verbose=False)
+    fused = fused_filter_signal(check_raw, l_freq, h_freq, notch_ch_types)
+    reference_data = reference.get_data()
+    error = np.abs(fused.get_data() - reference_data).max() / np.abs(reference_data).max()
+    logging.info(f'Fused filter relative error {error:.2e} (tolerance {tolerance:.0e})')
+    return error <= tolerance
+
+
 def filter_signal(raw, l_freq, h_freq, n_jobs, save_loc_eeg, eeg_bads_fname, save_loc_signal, signal_fname,
-                  epochs_parameters_dict, save=True):
+                  epochs_parameters_dict, save=True, fused=False, notch_ch_types=(), events=None, process_eeg=False,
+                  fused_tolerance=1e-6):
     """
     :param raw: signal to bandpass filter
     :param l_freq: lower cutoff frequency
     :param h_freq: higher cutoff frequency
     :param n_jobs: job control for speeding up computation
-    :param eeg: bool stating whether EEG is to be processed
     :param save_loc_eeg: string of location where bad EEG channels .txt can be found
     :param eeg_bads_fname: string of subject+paradigm specific filename for bad EEG channels .txt
     :param save_loc_signal: string of location in which we save the bandpass filtered signal
     :param signal_fname: string of filename for the bandpass filtered signal
+    :param fused: boolean, apply the bandpass and line noise notches in a single pass (see fused_filter_signal)
+    :param notch_ch_types: list of channel types whose line noise is notched in the fused pass
+    :param fused_tolerance: maximum error of the fused pass relative to the two-pass filtering, checked on the first
+    seconds of the signal; the signal is filtered in two passes beyond it
+    :param events: already found events, the bad EEG channel detection epochs around them
+    :param process_eeg: boolean, set the EEG montage and average reference, mark bad EEG channels and notch filter them
     :return: bandpass filtered signal
     """
-    raw.filter(l_freq=l_freq, h_freq=h_freq, n_jobs=n_jobs) # filter the signal accordingly
-    """
-    if raw.__contains__('eeg'):
+    if fused and check_fused_filter_tolerance(raw, l_freq, h_freq, notch_ch_types, n_jobs, fused_tolerance):
+        raw = fused_filter_signal(raw, l_freq, h_freq, notch_ch_types)
+    else:
+        raw.filter(l_freq=l_freq, h_freq=h_freq, n_jobs=n_jobs) # filter the signal accordingly
+        data_picks, notch_picks, line_harmonics = get_fused_filter_picks(raw.info, notch_ch_types)
+        if fused and len(notch_picks): # the same notches, in a second pass
+            raw.notch_filter(line_harmonics, picks=notch_picks, n_jobs=n_jobs)
+    if process_eeg and 'eeg' in raw:
         raw.set_montage('mgh70') # import correct cap layout
         raw.set_eeg_reference(ref_channels='average') # apply average reference
-        raw = apply_notch_filter_to_eeg(raw, n_jobs, save_loc_eeg, eeg_bads_fname, epochs_parameters_dict)
-    """
+        if fused and 'eeg' in notch_ch_types: # line noise already notched in the fused pass
+            raw = find_bads_eeg(raw, epochs_parameters_dict, n_jobs, save_loc_eeg, eeg_bads_fname, events)
+        else:
+            raw = apply_notch_filter_to_eeg(raw, n_jobs, save_loc_eeg, eeg_bads_fname, epochs_parameters_dict, events)
     if save:
         raw.save(join(save_loc_signal, signal_fname), overwrite=True)
     return raw
 
 
+def plan_decimation(sfreq, h_freq, freqs, tmin, tmax, oversampling=3., min_epoch_samples=100):
+    """
+    choose the largest integer decimation that keeps the filtered band and the analysis frequencies alias-free
+    :param sfreq: acquisition sampling frequency
+    :param h_freq: lowpass cutoff frequency already applied to the signal
+    :param freqs: analysis frequencies of interest
+    :param tmin: epoch start time, in seconds
+    :param tmax: epoch end time, in seconds
+    :param oversampling: minimum ratio between the decimated sampling frequency and the highest kept frequency
+    :param min_epoch_samples: minimum number of samples left per epoch
+    :return: integer decimation factor (1 -> no decimation)
+    """
+    keep_freq = max(h_freq, np.max(freqs))
+    decim = max(int(sfreq // (oversampling * keep_freq)), 1)
+    while decim > 1 and (tmax - tmin) * sfreq / decim < min_epoch_samples:
+        decim -= 1
+    return decim
+
+
+def decimate_signal(raw, events, decim, n_jobs, save_loc, decim_fname):
+    """
+    resample the (already lowpass filtered) signal and its events by an integer factor, recording the factor
+    :param raw: preloaded signal
+    :param events: events of the signal
+    :param decim: integer decimation factor from plan_decimation
+    :param decim_fname: string of filename to save the decimation factor and resulting sampling frequency to
+    :return: decimated signal, decimated events
+    """
+    original_sfreq = raw.info['sfreq']
+    if decim > 1:
+        raw, events = raw.resample(original_sfreq / decim, events=events, n_jobs=n_jobs)
+    logging.info(f'Decimated by {decim}: {original_sfreq} Hz -> {raw.info["sfreq"]} Hz')
+    np.savetxt(join(save_loc, decim_fname), [decim, original_sfreq, raw.info['sfreq']],
+               header='decimation factor, original sfreq, decimated sfreq')
+    return raw, events
+
+
 def generate_head_origin(info, subject_meg_dir, head_origin_fname): # calculate, save head origin coordinates
     """
     :param info: MNE Info object
@@ -105,8 +269,61 @@ def ssp_ecg(raw, ssp_params, ecg_fab_channels, n_jobs, proj_fname, proj_save_loc
         i_o.log_projs(qrs_projs, 'ECG')
     return qrs_projs
 
+def band_filter_candidate_channels(raw, channels, l_freq, h_freq, n_jobs, target_sfreq=250.):
+    """
+    :param raw: raw file holding the candidate channels
+    :param channels: list of strings of candidate channel names
+    :return: candidate channels band filtered in one batched pass, decimated towards target_sfreq
+    :return: sampling frequency of the returned data
+    """
+    candidates_data = raw.get_data(picks=channels)
+    candidates_data = mne.filter.filter_data(candidates_data, raw.info['sfreq'], l_freq, h_freq, n_jobs=n_jobs,
+                                             verbose=False)
+    decim = max(int(raw.info['sfreq'] // target_sfreq), 1) # content is below h_freq, decimating is safe
+    return candidates_data[:, ::decim], raw.info['sfreq'] / decim
+
+
+def score_ecg_candidate_channels(raw, channels, n_jobs, l_freq=5., h_freq=35., min_period=0.33, max_period=1.5):
+    """
+    score how well heartbeats can be detected on each candidate channel: the peak normalized autocorrelation of the
+    QRS band energy at lags of plausible heart rates (40-180 bpm)
+    :return: array of scores, one per channel
+    """
+    data, sfreq = band_filter_candidate_channels(raw, channels, l_freq, h_freq, n_jobs)
+    energy = data ** 2
+    energy -= energy.mean(axis=1, keepdims=True)
+    n_fft = 2 ** int(np.ceil(np.log2(2 * energy.shape[1] - 1))) # zero padded, no circular wrap
+    autocorr = np.fft.irfft(np.abs(np.fft.rfft(energy, n_fft, axis=1)) ** 2, n_fft, axis=1)
+    autocorr /= autocorr[:, :1]
+    return autocorr[:, int(min_period * sfreq):int(max_period * sfreq) + 1].max(axis=1)
+
+
+def score_eog_candidate_channels(raw, channels, n_jobs, l_freq=1., h_freq=10.):
+    """
+    score how well eye blinks can be detected on each candidate channel: blinks are rare, large deflections so
+    the kurtosis of the blink band signal grows with their prominence
+    :return: array of scores, one per channel
+    """
+    data, sfreq = band_filter_candidate_channels(raw, channels, l_freq, h_freq, n_jobs)
+    return scipy.stats.kurtosis(data, axis=1)
+
+
+def rank_candidate_channels(channels, scores, kind):
+    """
+    :return: list of channel names, best scoring first
+    """
+    ranked_channels = [channels[idx] for idx in np.argsort(scores)[::-1]]
+    logging.info(f'{kind} candidate channel scores: {dict(zip(channels, np.round(scores, 3)))}')
+    return ranked_channels
+
+
 def find_ecg_artifacts_without_ecg_channel(raw, ssp_params, ecg_fab_channels, n_jobs):
-    for channel in ecg_fab_channels:
+    qrs_projs = []
+    ecg_fab_channels = [channel for channel in ecg_fab_channels if channel in raw.ch_names]
+    if not ecg_fab_channels:
+        return qrs_projs
+    scores = score_ecg_candidate_channels(raw, ecg_fab_channels, n_jobs)
+    for channel in rank_candidate_channels(ecg_fab_channels, scores, 'ECG'): # normally only the best is needed
         qrs_projs, qrs = mne.preprocessing.ssp.compute_proj_ecg(raw, **ssp_params, n_jobs=n_jobs, ch_name=channel)
         if qrs_projs:
             break
@@ -130,53 +347,225 @@ def find_eog_artifacts_without_eog_channel(raw, ssp_params, eog_fab_channels, n_
     else:
         eog_fab_channels_available = [eog_fch_avail for eog_fch_avail in eog_fab_channels if 'EEG' not in eog_fch_avail]
 
-    for channel in eog_fab_channels_available:
+    blink_projs = []
+    eog_fab_channels_available = [channel for channel in eog_fab_channels_available if channel in raw.ch_names]
+    if not eog_fab_channels_available:
+        return blink_projs
+    scores = score_eog_candidate_channels(raw, eog_fab_channels_available, n_jobs)
+    for channel in rank_candidate_channels(eog_fab_channels_available, scores, 'EOG'): # normally only the best is needed
         blink_projs, blinks = mne.preprocessing.ssp.compute_proj_eog(raw, **ssp_params, n_jobs=n_jobs, ch_name=channel)
         if blink_projs:
             break
     return blink_projs
 
 
+def get_reject_picks(info):
+    """
+    :param info: MNE Info object of the epochs
+    :return: dictionary whose keys are channel types present, values are indices of their good channels
+    """
+    picks_by_type = {'mag': mne.pick_types(info, meg='mag'), 'grad': mne.pick_types(info, meg='grad'),
+                     'eeg': mne.pick_types(info, meg=False, eeg=True)}
+    return {ch_type: picks for ch_type, picks in picks_by_type.items() if len(picks)}
+
+
+def learn_reject_thresholds(data, picks_by_type, n_folds=5, n_thresholds=40, min_quantile=0.9, loss_decim=4,
+                            random_state=42):
+    """
+    learn a global peak-to-peak rejection threshold per channel type by cross-validation: the mean of the training
+    epochs under a threshold should match the (robust) median of the held out epochs
+    :param data: epochs data array (n_epochs, n_channels, n_times)
+    :param picks_by_type: dictionary returned by get_reject_picks
+    :param n_thresholds: number of candidate thresholds, taken as quantiles of the epochs' peak-to-peak amplitudes
+    :param min_quantile: lowest candidate quantile, so at most this fraction of epochs can be dropped per channel type
+    :param loss_decim: time decimation of the data the loss is computed on
+    :return: dictionary of thresholds per channel type
+    :return: array of peak-to-peak amplitudes (n_epochs, n_channels)
+    """
+    ptp = data.max(axis=2) - data.min(axis=2) # every epoch and channel at once
+    n_epochs = len(data)
+    folds = np.array_split(np.random.RandomState(random_state).permutation(n_epochs), min(n_folds, n_epochs))
+    thresholds = {}
+    for ch_type, picks in picks_by_type.items():
+        epochs_ptp = ptp[:, picks].max(axis=1)
+        candidates = np.unique(np.quantile(epochs_ptp, np.linspace(min_quantile, 1., n_thresholds)))
+        loss_data = data[:, picks, ::loss_decim].reshape(n_epochs, -1)
+        losses = np.zeros((len(folds), len(candidates)))
+        for fold_idx, validation in enumerate(folds):
+            train = np.setdiff1d(np.arange(n_epochs), validation)
+            train = train[np.argsort(epochs_ptp[train])] # ascending peak-to-peak, each threshold keeps a prefix
+            n_kept = np.maximum(np.searchsorted(epochs_ptp[train], candidates, side='right'), 1)
+            validation_median = np.median(loss_data[validation], axis=0)
+            running_sum, start = np.zeros(loss_data.shape[1]), 0
+            for candidate_idx, stop in enumerate(n_kept): # cumulative sum over the sorted training epochs
+                running_sum += loss_data[train[start:stop]].sum(axis=0)
+                start = stop
+                losses[fold_idx, candidate_idx] = np.sqrt(np.mean((running_sum / stop - validation_median) ** 2))
+        thresholds[ch_type] = float(candidates[np.argmin(losses.mean(axis=0))])
+    return thresholds, ptp
+
+
+def reject_epochs_learned(epochs, save_loc, drop_log_fname, max_drop_fraction=0.1):
+    """
+    drop epochs exceeding learned peak-to-peak thresholds, saving the thresholds and dropped events to a compact log
+    :param epochs: preloaded epochs
+    :param drop_log_fname: string of the JSON drop log filename
+    :param max_drop_fraction: at most this fraction of the epochs is dropped over all channel types, those exceeding
+    their thresholds the most
+    :return: epochs with the rejected epochs dropped
+    """
+    picks_by_type = get_reject_picks(epochs.info)
+    if not picks_by_type or len(epochs) < 2:
+        return epochs
+    n_epochs = len(epochs)
+    thresholds, ptp = learn_reject_thresholds(epochs.get_data(), picks_by_type)
+    ch_types = list(picks_by_type)
+    # peak-to-peak amplitude relative to the threshold, per epoch and channel type
+    ratios = np.column_stack([ptp[:, picks_by_type[ch_type]].max(axis=1) / thresholds[ch_type] for ch_type in ch_types])
+    worst_ratios = ratios.max(axis=1)
+    bad_epochs = np.where(worst_ratios > 1.)[0]
+    max_dropped = int(max_drop_fraction * n_epochs)
+    if len(bad_epochs) > max_dropped:
+        logging.info(f'{len(bad_epochs)} epochs exceed the learned thresholds, only the worst {max_dropped} are dropped')
+        bad_epochs = np.sort(bad_epochs[np.argsort(worst_ratios[bad_epochs])[::-1][:max_dropped]])
+    worst_types = ratios.argmax(axis=1) # each dropped epoch is attributed to the channel type exceeding the most
+    dropped = {}
+    remaining = np.arange(n_epochs) # original indices of the epochs not dropped yet
+    for type_idx, ch_type in enumerate(ch_types):
+        positions = np.where(np.isin(remaining, bad_epochs[worst_types[bad_epochs] == type_idx]))[0]
+        dropped[ch_type] = epochs.events[positions, 0].tolist() # event samples
+        epochs.drop(positions, reason=f'PTP_{ch_type.upper()}')
+        remaining = np.delete(remaining, positions)
+    logging.info(f'Learned peak-to-peak thresholds {thresholds}, kept {len(epochs)} of {n_epochs} epochs')
+    i_o.save_drop_log({'thresholds': thresholds, 'n_epochs': n_epochs, 'n_kept': len(epochs),
+                       'dropped_event_samples': dropped}, save_loc, drop_log_fname)
+    return epochs
+
+
 def generate_epochs(raw, events, conditions_dicts, epochs_parameters_dict,
-                    save_loc, epoch_pattern):
+                    save_loc, epoch_pattern, epoch_store_name=None, drop_log_fname=None):
     """
+    epoch once around the union of all conditions' event IDs, then derive each condition as a subset of those epochs
     :param raw: raw file to create epochs from
     :param events: numpy array containing events over time
     :param conditions_dicts: dictionary of dictionaries detailing various conditon names, and their event IDs
     :param epochs_parameters_dict: dictionary of epoching parameters
+    :param epoch_store_name: string of the shared epoch store to save to, None saves one .fif per condition
+    :param drop_log_fname: string of the drop log filename, if given epochs are rejected by learned thresholds
     """
     #if not raw.__contains__('eeg'):
     #    del epochs_parameters_dict['reject']['eeg']
-    for condition_name, condition_info in conditions_dicts.items(): # loop through each condition
-        condition_event_id = condition_info['event_id'] # event identifiers to epoch around
-        epochs_parameters_dict.update({'event_id': condition_event_id})
-        epochs = mne.Epochs(raw, events, **epochs_parameters_dict) # calculate the epochs
+    events_present = set(events[:, 2])
+    conditions_event_ids = {} # condition name -> event IDs found in the recording
+    for condition_name, condition_info in conditions_dicts.items():
+        condition_event_id = [event_id for event_id in condition_info['event_id'] if event_id in events_present]
+        if not condition_event_id:
+            logging.info(f'No events found for condition {condition_name}, event IDs {condition_info["event_id"]}')
+            continue
+        conditions_event_ids[condition_name] = condition_event_id
+    if not conditions_event_ids:
+        return
+
+    union_event_id = sorted(set(event_id for ids in conditions_event_ids.values() for event_id in ids))
+    union_parameters_dict = dict(epochs_parameters_dict, event_id=union_event_id)
+    epochs_union = mne.Epochs(raw, events, preload=True, **union_parameters_dict) # extract, baseline, project once
+    if drop_log_fname:
+        epochs_union = reject_epochs_learned(epochs_union, save_loc, drop_log_fname)
+    if epoch_store_name:
+        conditions_indices = {condition_name: np.where(np.in1d(epochs_union.events[:, 2], condition_event_id))[0]
+                              for condition_name, condition_event_id in conditions_event_ids.items()}
+        i_o.log_epochs(epochs_union)
+        i_o.save_epoch_store(epochs_union, conditions_indices, save_loc, epoch_store_name)
+        return epochs_union
+    for condition_name, condition_event_id in conditions_event_ids.items(): # loop through each condition
+        epochs = epochs_union[[str(event_id) for event_id in condition_event_id]] # integer event IDs are keyed as strings
         i_o.log_epochs(epochs)
         i_o.save_epochs(epochs, condition_name, save_loc, epoch_pattern) # save the epochs accordingly
+    return epochs_union
 
 
-def calc_head_position(raw, save_loc, fname):
+def compute_chpi_locs_chunk(raw, start, stop, margin):
     """
-    calculate head position matrix for movement compensation during SSS/maxwell filtering
-    :param raw: raw file to generate head position matrix for
-    :return: head postion array
+    fit cHPI coil locations over one time chunk of a recording
+    :param raw: raw file (may be read lazily) holding the cHPI signals
+    :param start: first sample of the chunk
+    :param stop: sample after the last one of the chunk
+    :param margin: number of extra samples read on each side, so fitting windows at the chunk edges are complete
+    :return: cHPI locations dictionary of the fits whose times fall within the chunk
     """
-    try:
-        chpi_amplitudes = mne.chpi.compute_chpi_amplitudes(raw)
-        chpi_locs = mne.chpi.compute_chpi_locs(raw.info, chpi_amplitudes)
-        head_pos = mne.chpi.compute_head_pos(raw.info, chpi_locs)
-        np.savetxt(join(save_loc, fname), head_pos)
-    except:
-        head_pos = None
+    sfreq = raw.info['sfreq']
+    chunk = raw.copy().crop(tmin=max(start - margin, 0) / sfreq, tmax=(min(stop + margin, len(raw.times)) - 1) / sfreq)
+    chpi_amplitudes = mne.chpi.compute_chpi_amplitudes(chunk)
+    chpi_locs = mne.chpi.compute_chpi_locs(chunk.info, chpi_amplitudes)
+    # fit times include first_samp, keep each fit in exactly one chunk
+    keep = ((chpi_locs['times'] >= (raw.first_samp + start) / sfreq) &
+            (chpi_locs['times'] < (raw.first_samp + stop) / sfreq))
+    return {key: value[keep] for key, value in chpi_locs.items()}
+
+
+def calc_run_head_position(raw, n_jobs, chunk_duration=60., margin_duration=1.):
     """
-    if not raw.__contains__('chpi'):
-        head_pos = None
-    else:
-        chpi_amplitudes = mne.chpi.compute_chpi_amplitudes(raw)
-        chpi_locs = mne.chpi.compute_chpi_locs(raw.info, chpi_amplitudes)
-        head_pos = mne.chpi.compute_head_pos(raw.info, chpi_locs)
-        np.savetxt(join(save_loc, fname), head_pos)
+    fit cHPI locations over time chunks in parallel, stitch them and compute the head positions of one recording
+    :param raw: raw file (may be read lazily)
+    :param n_jobs: number of chunks fitted at once
+    :param chunk_duration: chunk length in seconds
+    :return: head position array, times in seconds since the recording's first sample
+    """
+    sfreq = raw.info['sfreq']
+    chunk_samples = int(round(chunk_duration * sfreq))
+    chunk_limits = [(start, min(start + chunk_samples, len(raw.times))) for start in range(0, len(raw.times), chunk_samples)]
+    parallel, p_fun, _ = mne.parallel.parallel_func(compute_chpi_locs_chunk, min(n_jobs, len(chunk_limits)))
+    chunks_locs = parallel(p_fun(raw, start, stop, int(round(margin_duration * sfreq))) for start, stop in chunk_limits)
+    chpi_locs = {key: np.concatenate([chunk_locs[key] for chunk_locs in chunks_locs]) for key in chunks_locs[0]}
+    head_pos = mne.chpi.compute_head_pos(raw.info, chpi_locs) # sequential, each fit starts from the previous one
+    head_pos[:, 0] -= raw.first_samp / sfreq
+    return head_pos
+
+
+def calc_head_position(raw, save_loc, fname, run_paths=None, n_jobs=1, chunk_duration=60., margin_duration=1.):
+    """
+    calculate head position matrix for movement compensation during SSS/maxwell filtering
+    :param raw: raw file to generate head position matrix for (runs concatenated in the order of run_paths)
+    :param run_paths: list of strings of the runs' full paths; each run's head positions are cached next to save_loc,
+    keyed on the run's content hash and the fitting parameters, and reused on reprocessing (None fits raw as a whole,
+    without caching)
+    :param n_jobs: number of time chunks fitted at once
+    :param chunk_duration: chunk length in seconds
+    :param margin_duration: seconds of extra data read on each side of a chunk
+    :return: head postion array, None without cHPI (no movement compensation)
     """
+    runs = [(None, raw)] if run_paths is None else [(run_path, mne.io.read_raw_fif(run_path, verbose=False))
+                                                      for run_path in run_paths]
+    if not all(run_raw.info['hpi_meas'] for run_path, run_raw in runs):
+        logging.info('No cHPI measurement in the recording, head position is not calculated')
+        return None
+    # the fitting parameters are MNE's defaults, covered by its version
+    fit_key = hashlib.sha1(f'{chunk_duration}_{margin_duration}_{mne.__version__}'.encode()).hexdigest()[:8]
+    head_pos_runs = []
+    run_offset = 0 # samples of the runs preceding the current one in the concatenation
+    for run_path, run_raw in runs:
+        run_cache_fname = None
+        if run_path is not None:
+            run_hash = stage_cache.hash_file_content(run_path)[:12]
+            run_cache_fname = f'{basename(run_path).replace(".fif", "")}_{run_hash}_{fit_key}_head_pos.txt'
+        if run_cache_fname and exists(join(save_loc, run_cache_fname)):
+            run_head_pos = np.loadtxt(join(save_loc, run_cache_fname), ndmin=2)
+            logging.info(f'Reusing cached head positions {run_cache_fname}')
+        else:
+            try:
+                run_head_pos = calc_run_head_position(run_raw, n_jobs, chunk_duration, margin_duration)
+            except (RuntimeError, ValueError): # cHPI recorded, but the coils could not be fitted
+                logging.error(f'Head position of {run_path or "the recording"} could not be calculated, SSS is run '
+                              f'without movement compensation', exc_info=True)
+                return None
+            if run_cache_fname:
+                np.savetxt(join(save_loc, run_cache_fname), run_head_pos)
+        run_head_pos = run_head_pos.copy()
+        run_head_pos[:, 0] += (raw.first_samp + run_offset) / raw.info['sfreq'] # onto the concatenated time axis
+        head_pos_runs.append(run_head_pos)
+        run_offset += len(run_raw.times)
+    head_pos = np.concatenate(head_pos_runs)
+    np.savetxt(join(save_loc, fname), head_pos)
     return head_pos
 
 
@@ -196,20 +585,113 @@ def find_bads_meg(raw, sss_params, subject_preproc_dir, meg_bads_fname, n_jobs):
     return bads
 
 
-def find_bads_eeg(raw, epochs_parameters_dict, n_jobs, subject_preproc_dir, eeg_bads_fname):
-    
-    events = mne.find_events(raw, stim_channel='STI101', shortest_event=1)
-    eeg_data = raw.copy().pick_types(meg=False, eeg=True)
+spline_legendre_terms = 50 # Legendre terms of MNE's channel interpolation (mne.channels.interpolation._calc_g)
 
-    eeg_epochs = mne.Epochs(eeg_data, events, tmin=epochs_parameters_dict['tmin'], tmax=epochs_parameters_dict['tmax'],
-                            baseline=epochs_parameters_dict['baseline'], proj=False, reject=None, preload=True)
 
-    picks = mne.pick_types(eeg_epochs.info, meg=False, eeg=True)
+def spherical_spline_g(cosang, stiffness=4, n_legendre_terms=spline_legendre_terms):
+    """ spherical spline function g of Perrin et al. (1989), as used by MNE's channel interpolation"""
+    factors = [(2 * n + 1) / (n ** stiffness * (n + 1) ** stiffness * 4 * np.pi) for n in range(1, n_legendre_terms + 1)]
+    return np.polynomial.legendre.legval(cosang, [0] + factors)
 
-    ransac = autoreject.Ransac(unbroken_time=0.3, picks=picks, n_jobs=n_jobs)
-    ransac.fit(eeg_epochs)
 
-    bads = ransac.bad_chs_
+def fit_sphere_to_positions(pos):
+    """
+    :param pos: array of sensor positions (n_sensors, 3)
+    :return: positions centered on, and projected onto, the least squares sphere through them
+    """
+    lhs = np.hstack([2 * pos, np.ones((len(pos), 1))])
+    center = np.linalg.lstsq(lhs, (pos ** 2).sum(axis=1), rcond=None)[0][:3]
+    pos_centered = pos - center
+    return pos_centered / np.linalg.norm(pos_centered, axis=1, keepdims=True)
+
+
+eeg_interpolation_cache = {} # interpolation matrices per montage and set of good channels
+
+
+def make_ransac_interpolation_matrices(ch_names, pos, n_resample, subset_size, random_state=42, alpha=1e-5,
+                                       cache_dir=None):
+    """
+    spherical spline interpolation matrices from every random channel subset to all channels, built in one batch
+    :param ch_names: list of good EEG channel names (the montage minus its bad channels)
+    :param pos: array of good EEG channel positions (n_channels, 3)
+    :param cache_dir: string denoting where matrices are also cached on disk (None -> memory only)
+    :return: array of subset channel indices (n_resample, subset_size)
+    :return: interpolation matrices (n_resample, n_channels, subset_size)
+    """
+    key_hash = hashlib.sha1(np.ascontiguousarray(pos).tobytes())
+    key_hash.update(','.join(ch_names).encode())
+    key_hash.update(f'{n_resample}_{subset_size}_{random_state}_{alpha}_{spline_legendre_terms}'.encode())
+    key = key_hash.hexdigest()
+    cache_path = join(cache_dir, f'eeg_ransac_{key}.npz') if cache_dir else None
+    if key not in eeg_interpolation_cache and cache_path and exists(cache_path):
+        with np.load(cache_path) as cached:
+            eeg_interpolation_cache[key] = (cached['subsets'], cached['interpolation'])
+    if key in eeg_interpolation_cache:
+        return eeg_interpolation_cache[key]
+
+    n_channels = len(pos)
+    rng = np.random.RandomState(random_state)
+    subsets = np.array([rng.choice(n_channels, subset_size, replace=False) for _ in range(n_resample)])
+    pos_sphere = fit_sphere_to_positions(pos)
+    g_all = spherical_spline_g(pos_sphere.dot(pos_sphere.T))
+    # linear systems of every subset, stacked: [[G_from + alpha*I, 1], [1, 0]]
+    systems = np.ones((n_resample, subset_size + 1, subset_size + 1))
+    systems[:, :subset_size, :subset_size] = g_all[subsets[:, :, np.newaxis], subsets[:, np.newaxis, :]]
+    systems[:, np.arange(subset_size), np.arange(subset_size)] += alpha
+    systems[:, subset_size, subset_size] = 0.
+    systems_inv = np.linalg.pinv(systems)
+    g_to_from = np.concatenate([np.transpose(g_all[:, subsets], (1, 0, 2)),
+                                np.ones((n_resample, n_channels, 1))], axis=2)
+    interpolation = np.matmul(g_to_from, systems_inv[:, :, :subset_size])
+
+    eeg_interpolation_cache[key] = (subsets, interpolation)
+    if cache_path:
+        np.savez(cache_path, subsets=subsets, interpolation=interpolation)
+    return subsets, interpolation
+
+
+def find_bads_eeg(raw, epochs_parameters_dict, n_jobs, subject_preproc_dir, eeg_bads_fname, events=None,
+                  max_epochs=100, n_resample=50, min_channels=0.25, min_corr=0.75, unbroken_time=0.3):
+    """
+    RANSAC bad EEG channel detection: each channel is predicted from random subsets of the other channels, channels
+    poorly correlated with their prediction in more than unbroken_time of the epochs are bad; epochs are decimated by
+    the largest factor keeping the signal's lowpass band alias-free (see plan_decimation)
+    :param raw: raw file to find bad EEG channels in
+    :param events: events to epoch around, found on the stimulus channel if None
+    :param max_epochs: epochs are strided down to at most this many
+    :return: raw file with bad EEG channels added to its header
+    """
+    if events is None:
+        events = mne.find_events(raw, stim_channel='STI101', shortest_event=1)
+    stride = max(len(events) // max_epochs, 1)
+    lowpass = raw.info['lowpass']
+    decim = plan_decimation(raw.info['sfreq'], lowpass, [lowpass], epochs_parameters_dict['tmin'],
+                            epochs_parameters_dict['tmax'])
+    eeg_epochs = mne.Epochs(raw, events[::stride], tmin=epochs_parameters_dict['tmin'], tmax=epochs_parameters_dict['tmax'],
+                            baseline=epochs_parameters_dict['baseline'], picks='eeg', proj=False, reject=None,
+                            preload=True, decim=decim, verbose=False)
+    picks = mne.pick_types(eeg_epochs.info, meg=False, eeg=True, exclude='bads')
+    ch_names = [eeg_epochs.ch_names[pick] for pick in picks]
+    pos = np.array([eeg_epochs.info['chs'][pick]['loc'][:3] for pick in picks])
+
+    subset_size = int(np.ceil(min_channels * len(picks)))
+    subsets, interpolation = make_ransac_interpolation_matrices(ch_names, pos, n_resample, subset_size,
+                                                                cache_dir=subject_preproc_dir)
+    in_subset = np.zeros((n_resample, len(picks)), bool)
+    in_subset[np.arange(n_resample)[:, np.newaxis], subsets] = True # a channel is not used to predict itself
+
+    data = eeg_epochs.get_data()[:, picks]
+    bad_log = np.zeros((len(data), len(picks)), bool)
+    for epoch_idx, epoch_data in enumerate(data):
+        predictions = np.matmul(interpolation, epoch_data[subsets]) # (n_resample, n_channels, n_times)
+        predictions[in_subset] = np.nan
+        predicted = np.nanmedian(predictions, axis=0)
+        corr = (epoch_data * predicted).sum(axis=1) / (np.linalg.norm(epoch_data, axis=1) *
+                                                      np.linalg.norm(predicted, axis=1))
+        bad_log[epoch_idx] = corr < min_corr
+
+    bads = [ch_name for ch_name, bad_fraction in zip(ch_names, bad_log.mean(axis=0)) if bad_fraction > unbroken_time]
+    logging.info(f'RANSAC bad EEG channels ({len(data)} epochs, decimated by {decim}): {bads}')
     raw.info['bads'].extend(bads)
     i_o.save_bad_channels(raw, bads, subject_preproc_dir, eeg_bads_fname) # save accordingly
     return raw
@@ -228,21 +710,221 @@ def mne_maxwell_filter_paradigm(raw, sss_params, subject_preproc_dir, subject_ss
     return sss
 
 
+def get_sss_segments(raw, skip_by_annotation=('edge', 'bad_acq_skip')):
+    """
+    :param raw: raw file (may be read lazily), runs concatenated with boundary annotations at their joins
+    :param skip_by_annotation: annotation descriptions bounding the segments, as passed to maxwell_filter (matched on
+    their start, case insensitive)
+    :return: list of (start, stop) sample limits of the contiguous segments maxwell_filter processes separately
+    """
+    n_samples = len(raw.times)
+    skip_kinds = tuple(kind.upper() for kind in skip_by_annotation)
+    skipped = [] # (start, stop) sample limits of the annotations splitting the recording
+    for annotation in raw.annotations:
+        if annotation['description'].upper().startswith(skip_kinds):
+            onset = raw.time_as_index(annotation['onset'], use_rounding=True, origin=raw.annotations.orig_time)[0]
+            stop = onset + int(round(annotation['duration'] * raw.info['sfreq']))
+            skipped.append((min(max(onset, 0), n_samples), min(max(stop, 0), n_samples)))
+    breakpoints = sorted({0, n_samples}.union(*skipped))
+    return [(start, stop) for start, stop in zip(breakpoints[:-1], breakpoints[1:])
+            if not any(skip_start <= start and stop <= skip_stop for skip_start, skip_stop in skipped)]
+
+
+def plan_sss_chunks(segments, n_samples, sfreq, chunk_duration, st_duration):
+    """
+    :param segments: list of (start, stop) sample limits of the contiguous segments (see get_sss_segments)
+    :param n_samples: number of samples in the recording
+    :param chunk_duration: chunk length in seconds, a multiple of st_duration
+    :param st_duration: tSSS window length in seconds (None without tSSS)
+    :return: list of (start, stop) sample limits; chunks never cross a segment edge and start on the segment's tSSS
+    windows (the final partial window stays with the one preceding it, as in maxwell_filter), skipped samples outside
+    the segments join the following chunk
+    """
+    chunk_samples = int(round(chunk_duration * sfreq))
+    window_samples = int(round(st_duration * sfreq)) if st_duration else 0
+    chunk_limits = []
+    for segment_start, segment_stop in segments:
+        start = segment_start
+        while start < segment_stop:
+            stop = min(start + chunk_samples, segment_stop)
+            if segment_stop - stop < window_samples: # keep the segment's final partial tSSS window with the previous one
+                stop = segment_stop
+            chunk_limits.append([start, stop])
+            start = stop
+    if not chunk_limits:
+        return [(0, n_samples)]
+    # tile the whole recording: samples skipped by annotation are carried by the chunk that follows them
+    chunk_limits[0][0] = 0
+    for previous_limits, limits in zip(chunk_limits[:-1], chunk_limits[1:]):
+        limits[0] = previous_limits[1]
+    chunk_limits[-1][1] = n_samples
+    return [tuple(limits) for limits in chunk_limits]
+
+
+def slice_head_pos(head_pos, start_time, stop_time, time_shift):
+    """
+    :param head_pos: head position array of the whole recording, times on its time axis
+    :param start_time: time of the chunk's first sample, on the recording's time axis
+    :param stop_time: time of the sample after the chunk's last one, on the recording's time axis
+    :param time_shift: chunk time minus recording time (a cropped run keeps its own first sample)
+    :return: head positions within the chunk, led by the position in effect at its start, on the chunk's time axis
+    (None if no position applies to the chunk)
+    """
+    chunk_head_pos = head_pos[(head_pos[:, 0] >= start_time) & (head_pos[:, 0] < stop_time)]
+    preceding = np.where(head_pos[:, 0] < start_time)[0]
+    if len(preceding) and (not len(chunk_head_pos) or chunk_head_pos[0, 0] > start_time):
+        leading_head_pos = head_pos[preceding[-1]].copy()
+        leading_head_pos[0] = start_time
+        chunk_head_pos = np.vstack([leading_head_pos, chunk_head_pos])
+    if not len(chunk_head_pos):
+        return None
+    chunk_head_pos = chunk_head_pos.copy()
+    chunk_first_time = start_time + time_shift
+    chunk_head_pos[:, 0] = np.maximum(chunk_head_pos[:, 0] + time_shift, chunk_first_time) # float round-off at the start
+    return chunk_head_pos
+
+
+def crop_sss_chunk(raw, sss_params, start, stop):
+    """
+    :param start: first sample of the chunk
+    :param stop: sample after the last one of the chunk
+    :return: chunk of raw, read from disk only when its data are accessed
+    :return: copy of sss_params whose head positions are the chunk's, on the chunk's own time axis
+    """
+    sfreq = raw.info['sfreq']
+    chunk = raw.copy().crop(tmin=start / sfreq, tmax=(stop - 1) / sfreq)
+    chunk_params = dict(sss_params)
+    if chunk_params.get('head_pos') is not None:
+        start_time = (raw.first_samp + start) / sfreq
+        chunk_params['head_pos'] = slice_head_pos(chunk_params['head_pos'], start_time, (raw.first_samp + stop) / sfreq,
+                                                  chunk.first_samp / sfreq - start_time)
+    return chunk, chunk_params
+
+
+def mne_maxwell_filter_chunk(raw, sss_params, start, stop, chunk_fname, basis_cache_dir=None, basis_memory_entries=None):
+    """
+    perform SSS/tSSS on a single chunk of a recording, reading only that chunk from disk
+    :param start: first sample of the chunk
+    :param stop: sample after the last one of the chunk
+    :param chunk_fname: string of the full path to save the SSS'd chunk to
+    :param basis_cache_dir: string of the SSS basis cache location, enabled again in worker processes
+    :param basis_memory_entries: number of SSS basis decompositions kept in memory by the worker
+    :return: chunk_fname
+    """
+    if basis_cache_dir:
+        sss_cache.enable_sss_basis_cache(basis_cache_dir, basis_memory_entries)
+    chunk, chunk_params = crop_sss_chunk(raw, sss_params, start, stop)
+    chunk_sss = mne.preprocessing.maxwell_filter(chunk, **chunk_params)
+    chunk_sss.save(chunk_fname, overwrite=True)
+    return chunk_fname
+
+
+def find_bads_meg_chunked(raw, sss_params, chunk_duration, subject_preproc_dir, meg_bads_fname):
+    """
+    automatic bad MEG channel detection chunk by chunk (find_bad_channels_maxwell loads the data it is given), a
+    channel noisy or flat in any chunk is bad
+    :param raw: raw file (not preloaded) to find bad MEG channels in
+    :param sss_params: dictionary containing relevant SSS/maxwell filtering parameters
+    :param chunk_duration: chunk length in seconds, planned as the SSS chunks (see plan_sss_chunks)
+    :return: bad channels detected
+    """
+    segments = get_sss_segments(raw, sss_params.get('skip_by_annotation', ('edge', 'bad_acq_skip')))
+    chunk_limits = plan_sss_chunks(segments, len(raw.times), raw.info['sfreq'], chunk_duration,
+                                   sss_params.get('st_duration'))
+    bads = []
+    for start, stop in chunk_limits:
+        chunk, chunk_params = crop_sss_chunk(raw, sss_params, start, stop)
+        for key in ['st_correlation', 'destination', 'st_duration']:
+            chunk_params.pop(key, None) # remove un-needed arguments from parameters dictionary
+        noisy, flat = mne.preprocessing.find_bad_channels_maxwell(chunk, **chunk_params)
+        bads.extend(ch_name for ch_name in noisy + flat if ch_name not in bads)
+    logging.info(f'Bad MEG channels of {len(chunk_limits)} chunks: {bads}')
+    i_o.save_bad_channels(raw, bads, subject_preproc_dir, meg_bads_fname) # save accordingly
+    return bads
+
+
+def mne_maxwell_filter_chunked(raw, sss_params, chunk_duration, subject_preproc_dir, subject_sss_fname, n_jobs=1,
+                               basis_cache_dir=None, basis_memory_entries=None):
+    """
+    perform SSS/tSSS chunk by chunk, each chunk is read from disk, filtered and written out independently (opt-in, see
+    maxwell_filter_config.sss_streaming; maxwell_filter on the whole recording is the default)
+    :param raw: raw file (not preloaded) to maxwell filter
+    :param sss_params: dictionary containing relevant SSS/maxwell filtering parameters
+    :param chunk_duration: chunk length in seconds, a multiple of the st_duration; chunks are planned per contiguous
+    segment (run) so the tSSS windows are those of maxwell_filter on the whole recording
+    :param n_jobs: number of chunks filtered at once (each worker holds one chunk in memory)
+    :param basis_cache_dir: string of the SSS basis cache location, None to disable
+    :param basis_memory_entries: number of SSS basis decompositions kept in memory by each worker
+    :return: SSS'd signal, read lazily from the saved file
+    """
+    segments = get_sss_segments(raw, sss_params.get('skip_by_annotation', ('edge', 'bad_acq_skip')))
+    chunk_limits = plan_sss_chunks(segments, len(raw.times), raw.info['sfreq'], chunk_duration,
+                                   sss_params.get('st_duration'))
+    chunk_fnames = [join(subject_preproc_dir, subject_sss_fname.replace('raw_sss.fif', f'chunk{chunk_idx}_raw_sss.fif'))
+                    for chunk_idx in range(len(chunk_limits))]
+    parallel, p_fun, _ = mne.parallel.parallel_func(mne_maxwell_filter_chunk, min(n_jobs, len(chunk_limits)))
+    # chunks are independent and stitched in order; see compare_sss_outputs for the check against maxwell_filter
+    parallel(p_fun(raw, sss_params, start, stop, chunk_fname, basis_cache_dir, basis_memory_entries)
+             for (start, stop), chunk_fname in zip(chunk_limits, chunk_fnames))
+    logging.info(f'{len(chunk_limits)} SSS chunks saved')
+
+    # stitch the chunks lazily, saving streams the data buffer by buffer
+    sss = mne.concatenate_raws([mne.io.read_raw_fif(chunk_fname) for chunk_fname in chunk_fnames])
+    sss.set_annotations(raw.annotations.copy()) # drop the boundary annotations added at the chunk joins
+    sss_path = join(subject_preproc_dir, subject_sss_fname)
+    sss.save(sss_path, overwrite=True)
+    del sss
+    for chunk_fname in chunk_fnames:
+        os.remove(chunk_fname)
+    return mne.io.read_raw_fif(sss_path)
+
+
+def compare_sss_outputs(raw, sss_params, sss_path, block_duration=60.):
+    """
+    compare a saved (chunked) SSS output with maxwell_filter run on the whole recording
+    :param raw: raw file the output was computed from
+    :param sss_params: dictionary of the SSS parameters used (head_pos on the recording's time axis)
+    :param sss_path: string of the full path of the saved output
+    :param block_duration: seconds of data compared at a time
+    :return: largest absolute difference relative to the largest absolute value of the reference, per channel type
+    """
+    reference = mne.preprocessing.maxwell_filter(raw, **sss_params)
+    output = mne.io.read_raw_fif(sss_path)
+    if len(output.times) != len(reference.times) or output.ch_names != reference.ch_names:
+        raise ValueError(f'{sss_path} does not match the shape of the unchunked SSS output')
+    block_samples = int(round(block_duration * raw.info['sfreq']))
+    picks_by_type = {'mag': mne.pick_types(reference.info, meg='mag'), 'grad': mne.pick_types(reference.info, meg='grad')}
+    max_diff = {ch_type: 0. for ch_type in picks_by_type}
+    max_abs = {ch_type: 0. for ch_type in picks_by_type}
+    for start in range(0, len(reference.times), block_samples):
+        stop = min(start + block_samples, len(reference.times))
+        reference_block = reference.get_data(start=start, stop=stop)
+        output_block = output.get_data(start=start, stop=stop)
+        for ch_type, picks in picks_by_type.items():
+            max_diff[ch_type] = max(max_diff[ch_type], np.abs(output_block[picks] - reference_block[picks]).max())
+            max_abs[ch_type] = max(max_abs[ch_type], np.abs(reference_block[picks]).max())
+    relative_diff = {ch_type: max_diff[ch_type] / max_abs[ch_type] for ch_type in picks_by_type if max_abs[ch_type]}
+    logging.info(f'{sss_path} vs unchunked maxwell_filter, largest relative difference: {relative_diff}')
+    return relative_diff
+
+
 def mne_maxwell_filter_erm(raw_erm, bads_list, sss_params, subject_preproc_dir, subject_erm_sss_fname, save=True):
     """
     perform SSS on ERM data - used for noise covariance matrices later during MRI processing
     :param raw: raw ERM file
-    :param bads_list: list of lists of strings containing automatically detected bad MEG channels
+    :param bads_list: list of strings (or list of lists of strings) containing automatically detected bad MEG channels
     :param sss_params: dictionary containing relevant SSS/maxwell filtering parameters
     :return: SSS'd ERM file
     """
+    sss_params = sss_params.copy() # leave the paradigm's parameters untouched
     # remove parameters from sss params dictionary for ERM processing
     for key in ['destination', 'head_pos']: # ERM processing does not need a head transformation matrix
         sss_params[key] = None # no need to perform movement compensation
     sss_params['coord_frame'] = 'meg'
     sss_params['origin'] = 'auto'
 
-    bads_list_flattened = [bad_ch for bads_sublist in bads_list for bad_ch in bads_sublist] # flatten the list of lists
+    bads_list_flattened = [bad_ch for bads_sublist in bads_list
+                           for bad_ch in ([bads_sublist] if isinstance(bads_sublist, str) else bads_sublist)] # flatten
     bads_unique = list(set(bads_list_flattened)) # remove duplicate channels that were auto-detected
 
     raw_erm.info['bads'].extend(bads_unique) # add bad channels to ERM fif header
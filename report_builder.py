@@ -0,0 +1,91 @@
+"""
+Report builder - collects figure references during the run and renders the HTML report once at the end
+Each subject visit appends its entries (figure, downscaled thumbnail, section, caption) to its own JSONL shard, so adding
+to the report costs the same for the first and the last visit and parallel visit jobs never write the same file;
+the report page shows the thumbnails, lazy-loaded, linking to the full resolution figures
+"""
+import json
+import html
+import logging
+import matplotlib.image
+from os import makedirs, listdir
+from os.path import join, basename, exists, relpath
+
+
+def get_shard_dir(report_dir, report_name):
+    return join(report_dir, f"{report_name.replace('.h5', '')}_shards")
+
+
+def add_report_entries(subject, visit, entries, report_dir, report_name, thumbnail_scale=0.25):
+    """
+    append figures to the subject visit's report shard
+    :param subject: string subject ID, captions the figures
+    :param visit: string visit date, captions the figures
+    :param entries: list of (section, figure path) tuples, missing figures are skipped
+    :param report_name: string of the report's filename
+    :param thumbnail_scale: thumbnail size relative to the figure
+    """
+    shard_dir = get_shard_dir(report_dir, report_name)
+    thumbnail_dir = join(shard_dir, 'thumbnails')
+    makedirs(thumbnail_dir, exist_ok=True)
+    with open(join(shard_dir, f'{subject}_{visit}.jsonl'), 'a') as shard:
+        for section, figure_path in entries:
+            if not exists(figure_path):
+                continue
+            thumbnail_path = join(thumbnail_dir, f'{subject}_{visit}_{basename(figure_path)}')
+            matplotlib.image.thumbnail(figure_path, thumbnail_path, scale=thumbnail_scale)
+            shard.write(json.dumps({'subject': subject, 'visit': visit, 'section': section, 'figure': figure_path,
+                                    'thumbnail': thumbnail_path}) + '\n')
+
+
+def read_report_entries(shard_dir):
+    """
+    :param shard_dir: string denoting where the report shards are
+    :return: dictionary whose keys are sections, values are lists of entries (the latest entry per subject visit)
+    """
+    sections = {}
+    for shard_fname in sorted(listdir(shard_dir)):
+        if not shard_fname.endswith('.jsonl'):
+            continue
+        with open(join(shard_dir, shard_fname)) as shard:
+            for line in shard:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # line cut short by an interrupted run
+                    continue
+                entry_key = (entry['subject'], entry.get('visit', '')) # re-runs replace earlier entries of the visit
+                sections.setdefault(entry['section'], {})[entry_key] = entry
+    return {section: list(entries.values()) for section, entries in sorted(sections.items())}
+
+
+def build_sensor_space_report(report_dir, report_name, title='Sensor space'):
+    """
+    render every shard's entries into a single HTML report
+    :param report_name: string of the report's filename, saved with an .html extension
+    :return: string path of the HTML report, None if no entries were added
+    """
+    shard_dir = get_shard_dir(report_dir, report_name)
+    if not exists(shard_dir):
+        logging.info(f'No report entries in {shard_dir}')
+        return None
+    sections = read_report_entries(shard_dir)
+    page = [f'<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>{html.escape(title)}</title>',
+            '<style>figure {display: inline-block; margin: 4px;} figcaption {text-align: center;}</style></head>',
+            f'<body>\n<h1>{html.escape(title)}</h1>',
+            '<ul>' + ''.join(f'<li><a href="#{html.escape(section)}">{html.escape(section)}</a></li>' for section in sections)
+            + '</ul>']
+    for section, entries in sections.items():
+        page.append(f'<h2 id="{html.escape(section)}">{html.escape(section)}</h2>')
+        for entry in entries:
+            caption = html.escape(f"{entry['subject']} {entry.get('visit', '')}".strip())
+            figure_src = html.escape(relpath(entry['figure'], report_dir))
+            thumbnail_src = html.escape(relpath(entry['thumbnail'], report_dir))
+            page.append(f'<figure><a href="{figure_src}"><img src="{thumbnail_src}" loading="lazy" '
+                        f'alt="{caption}"></a><figcaption>{caption}</figcaption></figure>')
+    page.append('</body>\n</html>\n')
+
+    report_path = join(report_dir, report_name.replace('.h5', '.html'))
+    with open(report_path, 'w') as report_file:
+        report_file.write('\n'.join(page))
+    logging.info(f'Report of {sum(len(entries) for entries in sections.values())} figures saved to {report_path}')
+    return report_path
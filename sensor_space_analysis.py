@@ -3,34 +3,96 @@ import mne
 import logging
 import io_helpers as i_o
 import analysis as anlys
+import artifact_registry as registry
 import visuals as vis
+import numpy as np
 from os.path import join
 
 
 def main(subject, subject_fnames, log):
     logging.basicConfig(filename=log, level=logging.DEBUG)
+    vis.start_render_pool(para_cfg.n_render_workers)
+    try:
+        analyze_sensor_space(subject, subject_fnames)
+    except Exception: # nothing of this subject is left for the next one, the failure itself is raised
+        vis.discard_renders()
+        registry.discard_artifacts()
+        raise
+    registry.clear_artifacts() # finish the background writes before the next stage or subject
+
+
+def analyze_sensor_space(subject, subject_fnames):
     for subdir in ['epochs_subdir', 'epochs_sensor_subdir']:
         i_o.check_and_build_subdir(subject_fnames[subdir])
+    if para_cfg.epoch_store:
+        epoch_store = i_o.read_epoch_store(subject_fnames['epochs_subdir'], subject_fnames['epoch_store'])
+    shared_trial_tfr = para_cfg.shared_trial_tfr and para_cfg.epoch_store
+    if shared_trial_tfr: # one wavelet transform over all stored trials, reduced per condition
+        epoch_sfreq = epoch_store['info']['sfreq']
+        tfr_decim = anlys.choose_tfr_decim(epoch_sfreq, para_cfg.freqs) if para_cfg.tfr_decim == 'auto' \
+            else para_cfg.tfr_decim
+        epoch_times = epoch_store['tmin'] + np.arange(epoch_store['data'].shape[-1]) / epoch_sfreq
+        anlys.calc_sensor_tfr_conditions(epoch_store['data'], epoch_store['info'], epoch_times, epoch_store['conditions'],
+                                         para_cfg.freqs, para_cfg.n_cycles, para_cfg.n_jobs,
+                                         subject_fnames['epochs_sensor_subdir'], subject_fnames['sensor_tfr'],
+                                         para_cfg.paradigm, float32=para_cfg.tfr_float32, decim=tfr_decim,
+                                         crop=para_cfg.tfr_crop, tolerance=para_cfg.tfr_tolerance)
 
+    conditions_psd = {} # per-condition spectra, computed as each condition is read when there is no epoch store
     for condition_name, condition_info in para_cfg.conditions_dicts.items(): # read epochs around conditions/event IDs
-        epoch_fname, evoked_fname, sensor_tfr_fname, sensor_tfr_plot_fname, sensor_psd_fname, sensor_psd_plot_fname \
-            = i_o.format_variable_names({'condition': condition_name}, subject_fnames['epoch'], subject_fnames['evoked'],
-                                        subject_fnames['sensor_tfr'], subject_fnames['sensor_tfr_plot'],
-                                        subject_fnames['sensor_psd'], subject_fnames['sensor_psd_plot'])
+        epoch_fname, evoked_fname, sensor_tfr_fname = i_o.format_variable_names(
+            {'condition': condition_name}, subject_fnames['epoch'], subject_fnames['evoked'], subject_fnames['sensor_tfr'])
 
-        epochs = mne.read_epochs(join(subject_fnames['epochs_subdir'], epoch_fname),
-                                 proj=para_cfg.epochs_parameters_dict['proj'], preload=True)
+        if para_cfg.epoch_store:
+            if condition_name not in epoch_store['conditions']: # no events were found for the condition
+                continue
+            epochs = i_o.read_epochs_from_store(epoch_store, condition_name)
+        else:
+            epochs = mne.read_epochs(join(subject_fnames['epochs_subdir'], epoch_fname),
+                                     proj=para_cfg.epochs_parameters_dict['proj'], preload=True)
+            condition_psd, psd_freqs = anlys.calc_sensor_psd_conditions(
+                epochs.get_data(), epochs.info, {condition_name: np.arange(len(epochs))}, para_cfg.freqs,
+                para_cfg.n_jobs, para_cfg.psd_method)
+            conditions_psd.update(condition_psd)
+            psd_info = epochs.info
         evoked = epochs.average(method='mean')
         evoked.save(join(subject_fnames['epochs_subdir'], evoked_fname))
 
-        anlys.calc_sensor_tfr(epochs, para_cfg.freqs, para_cfg.n_cycles, para_cfg.n_jobs,
-                             subject_fnames['epochs_sensor_subdir'], sensor_tfr_fname, para_cfg.paradigm)
-        anlys.compute_psd(evoked, para_cfg.freqs ,para_cfg.n_jobs, subject_fnames['epochs_sensor_subdir'], sensor_psd_fname)
+        if not shared_trial_tfr:
+            tfr_decim = anlys.choose_tfr_decim(epochs.info['sfreq'], para_cfg.freqs) if para_cfg.tfr_decim == 'auto' \
+                else para_cfg.tfr_decim
+            anlys.calc_sensor_tfr(epochs, para_cfg.freqs, para_cfg.n_cycles, para_cfg.n_jobs,
+                                 subject_fnames['epochs_sensor_subdir'], sensor_tfr_fname, para_cfg.paradigm,
+                                 tfr_decim, para_cfg.tfr_crop)
+
+        del epochs # released before the next condition is read
+
+    if para_cfg.epoch_store: # spectra of the stored trials, each transformed once, averaged per condition
+        psd_info = epoch_store['info']
+        conditions_psd, psd_freqs = anlys.calc_sensor_psd_conditions(epoch_store['data'], psd_info,
+                                                                     epoch_store['conditions'], para_cfg.freqs,
+                                                                     para_cfg.n_jobs, para_cfg.psd_method)
+    if not conditions_psd:
+        return
+    anlys.save_sensor_psd(conditions_psd, psd_freqs, psd_info, subject_fnames['epochs_sensor_subdir'],
+                          subject_fnames['sensor_psd'])
 
-        anlys.analyze_sensor_space_and_make_figures(subject_fnames['epochs_sensor_subdir'], sensor_tfr_fname, sensor_psd_fname,
-                                                    para_cfg.freqs, para_cfg.tfr_temporal_dict,
-                                                    sensor_tfr_plot_fname, sensor_psd_plot_fname)
+    for condition_name in conditions_psd:
+        sensor_tfr_fname, sensor_tfr_summary_fname, sensor_tfr_plot_fname, sensor_psd_plot_fname = \
+            i_o.format_variable_names({'condition': condition_name}, subject_fnames['sensor_tfr'],
+                                      subject_fnames['sensor_tfr_summary'], subject_fnames['sensor_tfr_plot'],
+                                      subject_fnames['sensor_psd_plot'])
+        anlys.analyze_sensor_space_and_make_figures(subject_fnames['epochs_sensor_subdir'], sensor_tfr_fname,
+                                                    subject_fnames['sensor_psd'], para_cfg.freqs,
+                                                    para_cfg.tfr_temporal_dict, sensor_tfr_plot_fname,
+                                                    sensor_psd_plot_fname, condition_name, para_cfg.tfr_windows,
+                                                    para_cfg.tfr_reductions, sensor_tfr_summary_fname)
 
-        vis.add_to_sensor_space_report(subject, condition_name, subject_fnames['epochs_sensor_subdir'],
+    vis.flush_renders() # every figure is saved before the report refers to it
+    for condition_name in conditions_psd:
+        sensor_tfr_plot_fname, sensor_psd_plot_fname = i_o.format_variable_names(
+            {'condition': condition_name}, subject_fnames['sensor_tfr_plot'], subject_fnames['sensor_psd_plot'])
+        vis.add_to_sensor_space_report(subject, subject_fnames['meg_date'], condition_name,
+                                       subject_fnames['epochs_sensor_subdir'],
                                        sensor_tfr_plot_fname, sensor_psd_plot_fname, para_cfg.tfr_temporal_dict,
                                        para_cfg.reports_dir, para_cfg.sensor_report_fname)
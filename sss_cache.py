@@ -0,0 +1,145 @@
+"""
+SSS basis cache - keeps the multipole basis, its regularization and pseudo-inverse on disk
+maxwell_filter and find_bad_channels_maxwell cannot be handed a precomputed basis, so the cache wraps MNE's
+internal decomposition step; its key hashes every argument of that step: sensor geometry and coil scaling
+(calibration/cross-talk adjusted), origin, int_order/ext_order, regularization, the good/bad channel mask and the MNE
+version; only decompositions of the recording's initial head position are kept on disk (movement compensation requests
+one per head position, used once), and the disk cache is bounded, dropping the least recently used decompositions
+"""
+import hashlib
+import inspect
+import logging
+import numpy as np
+import mne
+import mne.preprocessing.maxwell as mne_maxwell
+from collections import OrderedDict
+from os import makedirs, replace, getpid, listdir, remove, utime
+from os.path import join, exists, getmtime
+
+decomp_memory_cache = OrderedDict() # most recently used decompositions of this process
+max_memory_entries = 32 # per process (every subject and chunk worker holds its own), ~0.7 MB each
+# arguments of the wrapped step the cache was written against (MNE 0.20); another signature is left unwrapped
+supported_decomp_parameters = ('trans', 'all_coils', 'cal', 'regularize', 'exp', 'ignore_ref', 'coil_scale',
+                               'grad_picks', 'mag_picks', 'good_mask', 'mag_or_fine', 'bad_condition', 't', 'mag_scale')
+max_disk_entries = 512 # ~0.7 MB each
+
+
+def update_hash(arg_hash, value):
+    """ feed an argument of the decomposition (arrays, containers or plain values) into arg_hash"""
+    if isinstance(value, np.ndarray):
+        arg_hash.update(f'{value.dtype}{value.shape}'.encode())
+        arg_hash.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=str):
+            arg_hash.update(str(key).encode())
+            update_hash(arg_hash, value[key])
+    elif isinstance(value, (list, tuple)):
+        arg_hash.update(b'[')
+        for item in value:
+            update_hash(arg_hash, item)
+        arg_hash.update(b']')
+    else:
+        arg_hash.update(repr(value).encode())
+
+
+def hash_decomp_arguments(arguments):
+    """
+    :param arguments: dictionary of the decomposition's argument names and values
+    :return: string key of the decomposition
+    """
+    arg_hash = hashlib.sha1(mne.__version__.encode()) # decompositions may change between MNE versions
+    for name in sorted(arguments):
+        if name == 't': # time point of the head position, only used in log messages
+            continue
+        arg_hash.update(name.encode())
+        update_hash(arg_hash, arguments[name])
+    return arg_hash.hexdigest()
+
+
+def save_decomp(path, decomp):
+    tmp_path = f'{path}.{getpid()}.tmp.npz' # write then rename, parallel workers may share the cache
+    np.savez(tmp_path, *decomp)
+    replace(tmp_path, path)
+
+
+def load_decomp(path):
+    with np.load(path) as decomp_file:
+        decomp = [decomp_file[f'arr_{idx}'] for idx in range(len(decomp_file.files))]
+    utime(path) # mark as recently used, so eviction keeps it
+    return tuple(item.item() if item.ndim == 0 else item for item in decomp)
+
+
+def evict_decomps(cache_dir, max_entries=max_disk_entries):
+    """ remove the least recently used decompositions of cache_dir beyond max_entries"""
+    decomp_paths = [join(cache_dir, fname) for fname in listdir(cache_dir) if fname.endswith('.npz')
+                    and '.tmp.' not in fname]
+    if len(decomp_paths) <= max_entries:
+        return
+    mtimes = {}
+    for path in decomp_paths:
+        try:
+            mtimes[path] = getmtime(path)
+        except FileNotFoundError: # evicted by a parallel worker
+            continue
+    for path in sorted(mtimes, key=mtimes.get)[:len(mtimes) - max_entries]:
+        try:
+            remove(path)
+        except FileNotFoundError:
+            continue
+
+
+def is_reusable(arguments):
+    """ :return: False for decompositions of a later head position (movement compensation), computed once per run"""
+    return not arguments.get('t')
+
+
+def enable_sss_basis_cache(cache_dir, memory_entries=None):
+    """
+    route MNE's SSS basis decomposition through the memory and on-disk cache for the rest of the process
+    :param cache_dir: string denoting where decompositions are stored
+    :param memory_entries: number of decompositions kept in memory, None keeps max_memory_entries
+    :return: True if the cache is active, False if this MNE version has no decomposition step matching the one wrapped
+    """
+    global max_memory_entries
+    if memory_entries is not None:
+        max_memory_entries = memory_entries
+    get_decomp = getattr(mne_maxwell, '_get_decomp', None)
+    if get_decomp is None:
+        logging.info('SSS basis cache unavailable for this MNE version, the basis is recomputed per call')
+        return False
+    if getattr(get_decomp, 'cache_dir', None) == cache_dir:
+        return True
+    original_get_decomp = getattr(get_decomp, 'original', get_decomp)
+    decomp_signature = inspect.signature(original_get_decomp)
+    if tuple(decomp_signature.parameters) != supported_decomp_parameters:
+        logging.info(f'SSS basis cache unavailable for MNE {mne.__version__}, its decomposition step takes '
+                     f'{tuple(decomp_signature.parameters)}; the basis is recomputed per call')
+        return False
+    makedirs(cache_dir, exist_ok=True)
+
+    def cached_get_decomp(*args, **kwargs):
+        bound = decomp_signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = hash_decomp_arguments(bound.arguments)
+        if key in decomp_memory_cache:
+            decomp_memory_cache.move_to_end(key)
+        else:
+            decomp_path = join(cache_dir, f'{key}.npz')
+            if exists(decomp_path):
+                decomp = load_decomp(decomp_path)
+            else:
+                decomp = original_get_decomp(*args, **kwargs)
+                if is_reusable(bound.arguments):
+                    save_decomp(decomp_path, decomp)
+                    evict_decomps(cache_dir)
+            decomp_memory_cache[key] = decomp
+            if len(decomp_memory_cache) > max_memory_entries:
+                decomp_memory_cache.popitem(last=False)
+        # hand out copies so MNE never modifies the cached arrays
+        return tuple(item.copy() if isinstance(item, np.ndarray) else item for item in decomp_memory_cache[key])
+
+    cached_get_decomp.original = original_get_decomp
+    cached_get_decomp.cache_dir = cache_dir
+    mne_maxwell._get_decomp = cached_get_decomp
+    logging.info(f'SSS basis cache enabled in {cache_dir}')
+    return True
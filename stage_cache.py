@@ -0,0 +1,100 @@
+"""
+Stage cache - decides whether a pipeline stage has to be re-run
+A stage's fingerprint hashes its input files, the configuration values it depends on and the source code of the
+modules that implement it; the fingerprint is stored in a sidecar manifest next to the stage's output
+"""
+import mne
+import json
+import hashlib
+import logging
+import inspect
+from os import stat
+from os.path import join, exists
+
+
+def hash_file_stats(paths):
+    """
+    :param paths: list of strings denoting input files
+    :return: string digest of the files' names, sizes and modification times (cheap on network filesystems)
+    """
+    file_hash = hashlib.sha1()
+    for path in sorted(paths):
+        file_stat = stat(path)
+        file_hash.update(f'{path}:{file_stat.st_size}:{file_stat.st_mtime_ns}'.encode())
+    return file_hash.hexdigest()
+
+
+def hash_file_content(path, block_size=2 ** 23):
+    """
+    :param path: string denoting a file
+    :return: string digest of the file's content
+    """
+    content_hash = hashlib.sha1()
+    with open(path, 'rb') as content:
+        for block in iter(lambda: content.read(block_size), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def hash_params(params):
+    """
+    :param params: dictionary of configuration values the stage depends on
+    :return: string digest of the values
+    """
+    def to_serializable(value):
+        return value.tolist() if hasattr(value, 'tolist') else repr(value) # numpy arrays, scalars, other objects
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=to_serializable).encode()).hexdigest()
+
+
+def hash_code(modules):
+    """
+    :param modules: list of modules implementing the stage
+    :return: string digest of their source code and the MNE version
+    """
+    code_hash = hashlib.sha1(mne.__version__.encode())
+    for module in modules:
+        with open(inspect.getsourcefile(module), 'rb') as source:
+            code_hash.update(source.read())
+    return code_hash.hexdigest()
+
+
+def fingerprint_stage(input_paths, params, modules):
+    """
+    :param input_paths: list of strings denoting the stage's input files
+    :param params: dictionary of configuration values the stage depends on
+    :param modules: list of modules implementing the stage
+    :return: dictionary of the stage's input, parameter and code digests
+    """
+    return {'inputs': hash_file_stats(input_paths), 'params': hash_params(params), 'code': hash_code(modules)}
+
+
+def manifest_path(loc, output_fname):
+    return join(loc, f'{output_fname}.manifest.json')
+
+
+def is_stage_current(loc, output_fname, fingerprint):
+    """
+    :param loc: string denoting where the stage's output is saved
+    :param output_fname: string of the stage's output filename
+    :param fingerprint: dictionary returned by fingerprint_stage
+    :return: True if the output exists and was produced from identical inputs, parameters and code
+    """
+    if not exists(join(loc, output_fname)) or not exists(manifest_path(loc, output_fname)):
+        return False
+    with open(manifest_path(loc, output_fname)) as manifest_file:
+        try:
+            recorded = json.load(manifest_file)
+        except ValueError: # truncated/corrupt manifest, recompute
+            return False
+    changed = [key for key, digest in fingerprint.items() if recorded.get(key) != digest]
+    if changed:
+        logging.info(f'{output_fname} is out of date, changed: {changed}')
+        return False
+    logging.info(f'{output_fname} is up to date, skipping')
+    return True
+
+
+def record_stage(loc, output_fname, fingerprint):
+    """ write the sidecar manifest once the stage's output has been saved"""
+    with open(manifest_path(loc, output_fname), 'w') as manifest_file:
+        json.dump(fingerprint, manifest_file, indent=1)
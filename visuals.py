@@ -1,8 +1,80 @@
 import mne
+import logging
 import matplotlib.pyplot as plt
-from os.path import join, isfile
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join
 import io_helpers as i_o
-from mayavi import mlab
+import report_builder
+
+render_pool = None # figures are rendered in this process when no pool was started
+pending_renders = []
+
+
+def init_render_worker():
+    plt.switch_backend('Agg') # render straight to files, no display
+
+
+def start_render_pool(n_workers):
+    """
+    render figures in background worker processes for the rest of this process
+    :param n_workers: number of render processes, 0 renders in this process
+    """
+    global render_pool
+    if render_pool is not None or n_workers < 1:
+        return
+    try:
+        render_pool = ProcessPoolExecutor(max_workers=n_workers, initializer=init_render_worker)
+    except (OSError, AssertionError) as error: # ex: running inside a daemonic subject worker
+        logging.info(f'Render pool unavailable ({error!r}), figures are rendered in this process')
+
+
+def submit_render(render_func, *plot_spec):
+    """
+    :param render_func: module level function rendering and saving a figure from plot_spec
+    :param plot_spec: arrays and metadata the figure is drawn from (pickled to the render process)
+    """
+    global render_pool
+    if render_pool is not None:
+        try:
+            pending_renders.append(render_pool.submit(render_func, *plot_spec))
+            return
+        except (OSError, AssertionError) as error: # workers are started on the first submission
+            logging.info(f'Render pool unavailable ({error!r}), figures are rendered in this process')
+            render_pool = None
+    render_func(*plot_spec)
+
+
+def flush_renders():
+    """ wait until every submitted figure is saved (before reports use them), raising the first render error"""
+    errors = []
+    while pending_renders:
+        try:
+            pending_renders.pop(0).result()
+        except Exception as error:
+            logging.error(f'Rendering a figure failed: {error!r}')
+            errors.append(error)
+    if errors:
+        raise errors[0]
+
+
+def discard_renders():
+    """ wait for every submitted figure after a failure, logging render errors instead of raising them"""
+    while pending_renders:
+        try:
+            pending_renders.pop(0).result()
+        except Exception as error:
+            logging.error(f'Rendering a figure failed: {error!r}')
+
+
+def get_plot_picks(info, pick, exclude='bads'):
+    """ :return: indices of the 'meg' or 'eeg' channels of info"""
+    return mne.pick_types(info, meg=pick == 'meg', eeg=pick == 'eeg', exclude=exclude)
+
+
+def render_projs_topomap(projs, info, save_path):
+    fig_topo = mne.viz.plot_projs_topomap(projs, info, show=False) # plot, save topographies of SSP projections
+    fig_topo.savefig(save_path)
+    plt.close(fig_topo)
 
 
 def make_topomap(raw, projs, save_loc, ssp_topo_pattern, kind):
@@ -11,8 +83,7 @@ def make_topomap(raw, projs, save_loc, ssp_topo_pattern, kind):
     :param projs: projections to plot
     :param kind: string denoting whether the projections are EOG, ECG..."""
     fig_topo_fname = i_o.format_variable_names({'kind': kind}, ssp_topo_pattern)
-    fig_topo = mne.viz.plot_projs_topomap(projs, raw.info, show=False) # plot, save topographies of SSP projections
-    fig_topo.savefig(join(save_loc, fig_topo_fname))
+    submit_render(render_projs_topomap, projs, raw.info, join(save_loc, fig_topo_fname))
     return
 
 
@@ -25,85 +96,88 @@ def plot_evoked_sensor(epochs, save_loc, evoked_sensor_pattern):
     return
 
 
-def plot_sensor_space_tfr(itc, power, picks, save_loc, save_name):
+def render_sensor_space_tfr(itc_arrays, power_arrays, times, freqs, picks, save_path):
     fig, axs = plt.subplots(2, len(picks), sharex=True, sharey=True)
+    extent = [times[0], times[-1], freqs[0], freqs[-1]]
     for idx, pick in enumerate(picks):
         itc_ax = axs[0, idx] if len(picks) == 2 else axs[0]
         pow_ax = axs[1, idx] if len(picks) == 2 else axs[1]
-        itc.plot(picks=pick, baseline=None, show=False, combine='mean', axes=itc_ax, exclude='bads', colorbar=False)
-        power.plot(picks=pick, baseline=None, show=False, combine='mean', axes=pow_ax, exclude='bads', colorbar=False)
+        itc_ax.imshow(itc_arrays[idx], aspect='auto', origin='lower', extent=extent, cmap='RdBu_r')
+        pow_ax.imshow(power_arrays[idx], aspect='auto', origin='lower', extent=extent, cmap='RdBu_r')
         itc_ax.set_title(f'ITC: {pick.upper()}')
         pow_ax.set_title(f'Power: {pick.upper()}')
+        pow_ax.set_xlabel('Time (s)')
+    axs.flat[0].set_ylabel('Frequency (Hz)')
     fig.suptitle('Sensor space time-frequency')
-    fig.savefig(join(save_loc, save_name))
+    fig.savefig(save_path)
     plt.close(fig)
 
 
-def plot_sensor_channels_arrays_by_frequency(sensor_data, freqs, picks, save_loc, save_name):
+def plot_sensor_space_tfr(itc, power, picks, save_loc, save_name):
+    # channel averaged time-frequency maps of each channel type, as TFR.plot(combine='mean', exclude='bads')
+    itc_arrays = [itc.data[get_plot_picks(itc.info, pick)].mean(axis=0) for pick in picks]
+    power_arrays = [power.data[get_plot_picks(power.info, pick)].mean(axis=0) for pick in picks]
+    submit_render(render_sensor_space_tfr, itc_arrays, power_arrays, itc.times, itc.freqs, picks, join(save_loc, save_name))
+
 
+def render_sensor_channels_arrays_by_frequency(sensor_arrays, freq_arrays, picks, title_id, save_path):
     fig, axs = plt.subplots(1, len(picks), sharex=True, sharey=True)
     for idx, pick in enumerate(picks):
-        if isinstance(sensor_data, mne.time_frequency.AverageTFR):
-            sensor_array = sensor_data.copy().pick(picks=pick).data.mean(axis=2)
-            freq_array = sensor_data.freqs
-            title_id = sensor_data.method.split('-')[1]
-        else:
-            freq_array = freqs[idx]
-            sensor_array = sensor_data[idx]
-            sensor_array /= sensor_array.mean()
-            title_id = 'PSD'
-        if len(picks) == 2:
-            axs[idx].plot(freq_array, sensor_array.T)
-            axs[idx].set_title(pick.upper())
-            axs[idx].set_xlabel('Frequency [Hz]')
-        else:
-            axs.plot(freq_array, sensor_array.T)
-            axs.set_title(pick.upper())
-            axs.set_xlabel('Frequency [Hz]')
-            
+        ax = axs[idx] if len(picks) == 2 else axs
+        ax.plot(freq_arrays[idx], sensor_arrays[idx].T)
+        ax.set_title(pick.upper())
+        ax.set_xlabel('Frequency [Hz]')
     fig.suptitle(f'Sensor space {title_id}')
-    fig.savefig(join(save_loc, save_name))
+    fig.savefig(save_path)
     plt.close(fig)
 
 
-
-def plot_sensor_tfr_channels(sensor_array, freqs, save_loc, ch_plot_fname):
-
-    plt.figure(1, clear=True)
+def plot_sensor_channels_arrays_by_frequency(sensor_data, freqs, picks, save_loc, save_name):
+    if isinstance(sensor_data, mne.time_frequency.AverageTFR):
+        sensor_arrays = [sensor_data.data[get_plot_picks(sensor_data.info, pick, exclude=[])].mean(axis=2)
+                         for pick in picks]
+        freq_arrays = [sensor_data.freqs] * len(picks)
+        title_id = sensor_data.method.split('-')[1]
+    else:
+        sensor_arrays = [sensor_data[idx] / sensor_data[idx].mean() for idx in range(len(picks))]
+        freq_arrays = freqs
+        title_id = 'PSD'
+    submit_render(render_sensor_channels_arrays_by_frequency, sensor_arrays, freq_arrays, picks, title_id,
+                  join(save_loc, save_name))
+
+
+def render_sensor_tfr_channels(sensor_array, freqs, save_path, title):
+    fig = plt.figure()
     plt.plot(freqs, sensor_array.T)
     plt.ylim((0, 0.75))
     plt.xlabel('Frequency [Hz]', fontsize=12)
     plt.ylabel('Intertrial Coherence', fontsize=12)
-    plt.title(ch_plot_fname.replace('.png', ''), fontsize=12)
-    plt.savefig(join(save_loc, ch_plot_fname))
-    plt.close()
+    plt.title(title, fontsize=12)
+    fig.savefig(save_path)
+    plt.close(fig)
+
+
+def plot_sensor_tfr_channels(sensor_array, freqs, save_loc, ch_plot_fname):
+    submit_render(render_sensor_tfr_channels, sensor_array, freqs, join(save_loc, ch_plot_fname),
+                  ch_plot_fname.replace('.png', ''))
     return
 
 
-def add_to_sensor_space_report(subject, condition, sensor_subdir, sensor_tfr_plot_name, sensor_psd_plot_name,
+def add_to_sensor_space_report(subject, visit, condition, sensor_subdir, sensor_tfr_plot_name, sensor_psd_plot_name,
                                tfr_temporal_dict, report_dir, report_name):
-    i_o.check_and_build_subdir(report_dir)
-    report_path = join(report_dir, report_name) # full path to report's location
-    sensor_report = mne.open_report(report_path) if isfile(report_path) else mne.Report() # create or load report
-
+    """ record the condition's figures in the subject visit's report shard, the report is built once at the end of the run"""
     t_start = int(tfr_temporal_dict['t_start']* 1000)
     t_end = int(tfr_temporal_dict['t_end']* 1000)
 
-    # find and load corresponding images...
-    images_dict = {'PSD': i_o.find_file_matches(sensor_subdir, sensor_psd_plot_name),
-                   'TFR': i_o.find_file_matches(sensor_subdir, sensor_tfr_plot_name.replace('filler', 'TFR')),
-                   'ITC': i_o.find_file_matches(sensor_subdir, sensor_tfr_plot_name.replace('filler', f'{t_start}_{t_end}_ITC'))}
-
-    for fig_type, fig_matches in images_dict.items():
-        if not fig_matches:
-            continue
-        section = f'{condition}_{fig_type}'
-        sensor_report.add_images_to_section(join(sensor_subdir, fig_matches[0]), captions=subject, section=section, scale=3)
-
-    sensor_report.save(report_path, open_browser=False, overwrite=True)
+    images_dict = {'PSD': sensor_psd_plot_name,
+                   'TFR': sensor_tfr_plot_name.replace('filler', 'TFR'),
+                   'ITC': sensor_tfr_plot_name.replace('filler', f'{t_start}_{t_end}_ITC')}
+    entries = [(f'{condition}_{fig_type}', join(sensor_subdir, fig_name)) for fig_type, fig_name in images_dict.items()]
+    report_builder.add_report_entries(subject, visit, entries, report_dir, report_name)
 
 
 def plot_coreg_alignment(info, trans, subject, subjects_dir, save_loc, save_name):
+    from mayavi import mlab # 3D backend, only imported when an alignment is plotted
     fig_alignment = mne.viz.plot_alignment(info, trans, subject=subject,
                                            dig=True, meg=['helmet', 'sensors'],
                                            subjects_dir=subjects_dir, surfaces='brain')